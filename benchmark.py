@@ -0,0 +1,442 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import string
+import tempfile
+import itertools
+import importlib.util
+import multiprocessing as mp
+
+from instrumentation import peak_rss_mb
+
+'''
+benchmarks of the pipeline stages on synthetic fixtures (reddit lines with metadata, COCA-style n-gram tables,
+country corpora, facet embeddings, pairwise distances and etymology data), generated in a temporary directory;
+every stage runs in its own forked process, so that its peak RSS is measured in isolation, and stages whose
+dependencies are not installed are reported as skipped
+'''
+
+
+class Fixtures:
+	'''
+	synthetic inputs of the pipeline stages, sizes are multiples of the scale
+	'''
+	def __init__(self, directory, scale=1, seed=1):
+		self.directory = directory
+		self.rng = random.Random(seed)
+
+		self.lines = 5000 * scale  # lines per reddit file and per country corpus
+		self.countries = ['Country' + str(c) for c in range(10 + 2 * scale)]
+		self.words = Fixtures.make_words(self.rng, 2000 * scale)
+		self.focused = self.words[:200 * scale]
+		self.dim = 100
+
+		self.reddit_dir = self.subdir('reddit')
+		self.text_dir = self.subdir('text')
+		self.ngrams_dir = self.subdir('ngrams')
+		self.corpora_dir = self.subdir('corpora')
+		self.etymology_dir = self.subdir('etymology')
+
+		self.write_reddit_lines()
+		self.write_ngram_tables()
+		self.write_corpora()
+		self.write_embeddings()
+		self.write_distances()
+		self.write_etymology()
+	# end def
+
+	def subdir(self, name):
+		path = os.path.join(self.directory, name) + os.sep
+		os.makedirs(path)
+		return path
+	# end def
+
+	@staticmethod
+	def make_words(rng, count):
+		words = set()
+		while len(words) < count:
+			words.add(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10))))
+		# end while
+		return sorted(words)
+	# end def
+
+	def sentence(self):
+		tokens = []
+		for _ in range(self.rng.randint(3, 25)):
+			token = self.rng.choice(self.words)
+			kind = self.rng.random()
+			if kind < 0.1: token = token.capitalize()
+			elif kind < 0.12: token = token.upper()
+			elif kind < 0.14: token = 'https://www.' + token + '.com'
+			elif kind < 0.16: token = 'r/' + token
+			elif kind < 0.2: token = self.rng.choice(['.', ',', '?', '!', str(self.rng.randint(0, 100))])
+			tokens.append(token)
+		# end for
+		return ' '.join(tokens)
+	# end def
+
+	def write_reddit_lines(self):
+		subreddits = ['europe', 'AskEurope', 'news', 'pics', 'worldnews']
+		for country in self.countries[:2]:
+			with open(self.reddit_dir + 'reddit.' + country + '.500K', 'w') as fout:
+				for n in range(self.lines):
+					fout.write('[user' + str(n) + '] [' + self.rng.choice(subreddits) + '] ' + self.sentence() + '\n')
+				# end for
+			# end with
+			with open(self.text_dir + 'reddit.' + country + '.txt', 'w') as fout:
+				for _ in range(self.lines): fout.write(self.sentence().lower() + '\n')
+			# end with
+		# end for
+	# end def
+
+	def write_ngram_tables(self):
+		variants = [str.lower, str.capitalize, str.upper]
+		with open(self.ngrams_dir + 'w3.txt', 'w') as fout:
+			for _ in range(20 * self.lines):
+				trigram = [self.rng.choice(variants)(self.rng.choice(self.words)) for _ in range(3)]
+				fout.write(str(self.rng.randint(1, 10000)) + '\t' + '\t'.join(trigram) + '\n')
+			# end for
+		# end with
+		with open(self.ngrams_dir + 'w2.txt', 'w') as fout:
+			for _ in range(10 * self.lines):
+				bigram = [self.rng.choice(variants)(self.rng.choice(self.words)) for _ in range(2)]
+				fout.write(str(self.rng.randint(1, 10000)) + '\t' + '\t'.join(bigram) + '\n')
+			# end for
+		# end with
+	# end def
+
+	def write_corpora(self):
+		self.cfg_filename = self.corpora_dir + 'data.reddit.voc.cfg'
+		self.vocab_filename = self.corpora_dir + 'vocabulary.dat'
+		with open(self.cfg_filename, 'w') as fcfg:
+			for country in self.countries:
+				filename = self.corpora_dir + 'reddit.' + country + '.txt'
+				with open(filename, 'w') as fout:
+					for _ in range(self.lines): fout.write(self.sentence().lower() + '\n')
+				# end with
+				fcfg.write(filename + ' ' + country + ' 1\n')
+			# end for
+		# end with
+		with open(self.vocab_filename, 'w') as fout:
+			for word in self.words: fout.write(str(self.rng.randint(100, 100000)) + '\t' + word + '\n')
+		# end with
+	# end def
+
+	def write_embeddings(self):
+		self.embeddings_filename = self.directory + os.sep + 'out.embeddings'
+		with open(self.embeddings_filename, 'w') as fout:
+			for facet in ['MAIN'] + self.countries:
+				scale = 1.0 if facet == 'MAIN' else 0.1
+				for word in self.focused:
+					values = ' '.join('{0:.6f}'.format(self.rng.gauss(0.0, scale)) for _ in range(self.dim))
+					fout.write(facet + ' ' + word + ' ' + values + '\n')
+				# end for
+			# end for
+		# end with
+	# end def
+
+	def write_distances(self):
+		self.distances_filename = self.directory + os.sep + 'pairwise.distance.out'
+		distances = {}
+		with open(self.distances_filename, 'w') as fout:
+			for c1, c2 in itertools.product(self.countries, repeat=2):
+				if c1 == c2: distance = 0.0
+				else: distance = distances.setdefault(tuple(sorted((c1, c2))), self.rng.random())
+				fout.write(c1 + ' ' + c2 + ' distance: ' + str(distance) + '\n')
+			# end for
+		# end with
+	# end def
+
+	def write_etymology(self):
+		languages = ['lat', 'fra', 'ang', 'non', 'grc', 'deu']
+		self.etymology = {}
+		for word in self.words:
+			token = 'eng: ' + word
+			for depth in range(self.rng.randint(0, 3)):
+				root = self.rng.choice(languages) + ': ' + word[:-1] + str(depth)
+				self.etymology[token] = root
+				token = root
+			# end for
+		# end for
+
+		self.synsets = [self.rng.sample(self.words, self.rng.randint(2, 4)) for _ in range(len(self.words))]
+		self.lexicon_filename = self.etymology_dir + 'significant.words.dat'
+		with open(self.lexicon_filename, 'w') as fout:
+			for word in self.rng.sample(self.words, len(self.words) // 10): fout.write(word + '\n')
+		# end with
+		self.etymology_vocab_filename = self.etymology_dir + 'vocab.no.entities.pos.dat'
+		with open(self.etymology_vocab_filename, 'w') as fout:
+			for word in self.words: fout.write(word + '\t' + str(self.rng.randint(1, 100000)) + '\n')
+		# end with
+	# end def
+# end class
+
+
+def import_path(name, filename):
+	'''
+	import a script whose file name is not a valid module name, e.g., parse.etymology.py
+	'''
+	spec = importlib.util.spec_from_file_location(name, filename)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+# end def
+
+
+def quiet(function, *args):
+	# the stages print their progress, which would bury the report
+	with open(os.devnull, 'w') as devnull:
+		stdout, sys.stdout = sys.stdout, devnull
+		try: return function(*args)
+		finally: sys.stdout = stdout
+	# end with
+# end def
+
+
+# every bench_* function imports its modules and prepares its inputs, then returns the callable that is timed,
+# which runs the stage and returns the number of items processed and their unit
+
+def bench_url_cleanup(fixtures):
+	from preprocess_reddit_data import Parsing
+
+	def run():
+		quiet(Parsing.perform_url_cleanup, fixtures.text_dir)
+		return 2 * fixtures.lines, 'lines'
+	# end def
+	return run
+# end def
+
+
+def bench_language_cleanup(fixtures):
+	from preprocess_reddit_data import Utils
+
+	def run():
+		quiet(Utils.perform_cleanup, fixtures.reddit_dir)
+		return 2 * fixtures.lines, 'lines'
+	# end def
+	return run
+# end def
+
+
+def bench_load_ngrams(fixtures):
+	import preprocess_reddit_data
+	preprocess_reddit_data.NGRAMS_DIR = fixtures.ngrams_dir
+
+	def run():
+		preprocess_reddit_data.Frequency.load_frequencies()
+		return 30 * fixtures.lines, 'lines'
+	# end def
+	return run
+# end def
+
+
+def bench_true_case(fixtures):
+	import preprocess_reddit_data
+	preprocess_reddit_data.NGRAMS_DIR = fixtures.ngrams_dir
+	frequencies = preprocess_reddit_data.FrequencyTables(*preprocess_reddit_data.Frequency.load_frequencies())
+
+	input_dir = fixtures.subdir('truecase')
+	for filename in os.listdir(fixtures.text_dir):
+		if filename.endswith('.txt'): shutil.copy(fixtures.text_dir + filename, input_dir)
+	# end for
+
+	def run():
+		quiet(preprocess_reddit_data.SimpleTrueCasing.true_case, input_dir, frequencies)
+		return 2 * fixtures.lines, 'lines'
+	# end def
+	return run
+# end def
+
+
+def bench_create_features_map(fixtures):
+	from extract_word_count import Classification
+	# the count matrix is saved to the working directory
+	os.chdir(fixtures.corpora_dir)
+
+	def run():
+		quiet(Classification.create_features_map, fixtures.cfg_filename, fixtures.vocab_filename)
+		return len(fixtures.countries) * fixtures.lines, 'lines'
+	# end def
+	return run
+# end def
+
+
+def bench_parse_embeddings(fixtures):
+	from pairwise_distance import parse_embeddings
+
+	def run():
+		parse_embeddings(fixtures.embeddings_filename, fixtures.countries, fixtures.focused)
+		return (len(fixtures.countries) + 1) * len(fixtures.focused), 'lines'
+	# end def
+	return run
+# end def
+
+
+def synthetic_distributions(fixtures):
+	rng = random.Random(2)
+	country_dist = {country: {word: rng.randint(0, 1000) / 1000.0 for word in fixtures.focused}
+					for country in fixtures.countries}
+	norm_dist = {word: rng.random() for word in fixtures.focused}
+	return country_dist, norm_dist
+# end def
+
+
+def bench_pairwise_legacy(fixtures):
+	from pairwise_distance import parse_embeddings, compute_pairwise_similarity_multiprocess
+	embeddings = parse_embeddings(fixtures.embeddings_filename, fixtures.countries, fixtures.focused)
+	country_dist, norm_dist = synthetic_distributions(fixtures)
+	pairs = list(itertools.combinations(fixtures.countries, 2))
+
+	def run():
+		for c1, c2 in pairs:
+			compute_pairwise_similarity_multiprocess(embeddings, fixtures.focused, country_dist, norm_dist, c1, c2)
+		# end for
+		return len(pairs), 'pairs'
+	# end def
+	return run
+# end def
+
+
+def bench_pairwise_condensed(fixtures):
+	import pairwise_distance as pd
+	embeddings = pd.parse_embeddings(fixtures.embeddings_filename, fixtures.countries, fixtures.focused)
+	country_dist, norm_dist = synthetic_distributions(fixtures)
+
+	def run():
+		tensor, present = pd.stack_embeddings(embeddings, fixtures.focused, fixtures.countries)
+		counts = pd.stack_word_counts(country_dist, fixtures.focused, fixtures.countries)
+		weights = pd.stack_word_weights(norm_dist, fixtures.focused)
+		condensed = pd.compute_condensed_distances(tensor, present, counts, weights, fixtures.countries)
+		return len(condensed), 'pairs'
+	# end def
+	return run
+# end def
+
+
+def bench_distance_matrix(fixtures):
+	from phylogenetic_tree import distance_matrix
+
+	def run():
+		quiet(distance_matrix, fixtures.distances_filename)
+		return len(fixtures.countries) ** 2, 'pairs'
+	# end def
+	return run
+# end def
+
+
+def bench_etymology_filters(fixtures):
+	etymology = import_path('parse_etymology', os.path.join(SOURCE_DIR, 'etymology', 'parse.etymology.py'))
+
+	def run():
+		roots = etymology.extract_words_roots(fixtures.etymology)
+
+		synsets = [synset for synset in fixtures.synsets if all(word in roots for word in synset)]
+		synsets = etymology.filter_out_country_specific_lexicon(synsets, fixtures.lexicon_filename)
+		synsets = quiet(etymology.filter_out_synsets_with_prevalent_words, synsets, fixtures.etymology_vocab_filename)
+		etymology.filter_out_etymologically_homogeneous_synsets(synsets, roots)
+		return len(fixtures.synsets), 'synsets'
+	# end def
+	return run
+# end def
+
+
+# stage name, benchmark function, modules required by the stage
+STAGES = [
+	('perform_url_cleanup', bench_url_cleanup, ['polyglot', 'numpy']),
+	('perform_cleanup', bench_language_cleanup, ['polyglot', 'numpy']),
+	('load_frequencies', bench_load_ngrams, ['polyglot', 'numpy']),
+	('true_case', bench_true_case, ['polyglot', 'numpy']),
+	('create_features_map', bench_create_features_map, ['numpy']),
+	('parse_embeddings', bench_parse_embeddings, ['numpy', 'scipy']),
+	('compute_pairwise_similarity_multiprocess', bench_pairwise_legacy, ['numpy', 'scipy']),
+	('compute_condensed_distances', bench_pairwise_condensed, ['numpy', 'scipy']),
+	('distance_matrix', bench_distance_matrix, ['numpy', 'scipy', 'sklearn', 'matplotlib']),
+	('etymology_filters', bench_etymology_filters, ['nltk']),
+]
+
+
+def run_stage(function, fixtures, connection):
+	try:
+		run = function(fixtures)
+		start = time.perf_counter()
+		items, unit = run()
+		seconds = time.perf_counter() - start
+		connection.send({'status': 'ok', 'seconds': round(seconds, 4), 'items': items, 'unit': unit,
+						 'rate': round(items / seconds, 1) if seconds > 0 else None, 'peak_rss_mb': peak_rss_mb()})
+	except Exception as e:
+		connection.send({'status': 'failed', 'reason': repr(e)})
+	# end try
+	connection.close()
+# end def
+
+
+def benchmark(fixtures, names=None):
+	'''
+	run the (selected) stages, each in a forked process
+	:param fixtures: Fixtures
+	:param names: optional stage names, all stages by default
+	:return: list of per-stage results
+	'''
+	results = []
+	for name, function, requires in STAGES:
+		if names and name not in names: continue
+		missing = [module for module in requires if importlib.util.find_spec(module) is None]
+		if missing:
+			results.append({'stage': name, 'status': 'skipped', 'reason': 'missing ' + ', '.join(missing)})
+			continue
+		# end if
+
+		receiver, sender = mp.Pipe(duplex=False)
+		process = mp.get_context('fork').Process(target=run_stage, args=(function, fixtures, sender))
+		process.start()
+		sender.close()
+		try:
+			result = receiver.recv()
+		except EOFError:  # the stage process died without reporting, e.g., killed when out of memory
+			result = None
+		# end try
+		process.join()
+		if result is None: result = {'status': 'failed', 'reason': 'exit code ' + str(process.exitcode)}
+
+		result = dict({'stage': name}, **result)
+		print(json.dumps(result), file=sys.stderr)
+		results.append(result)
+	# end for
+	return results
+# end def
+
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCALE = 1
+
+# invocation: "python benchmark.py [--scale <n>] [--output <file>] [stage ...]"
+
+if __name__ == '__main__':
+
+	sys.path.insert(0, SOURCE_DIR)
+	args = sys.argv[1:]
+	scale = int(args[args.index('--scale') + 1]) if '--scale' in args else SCALE
+	output = args[args.index('--output') + 1] if '--output' in args else None
+	names = [arg for n, arg in enumerate(args) if not arg.startswith('--') and (n == 0 or args[n - 1] not in ('--scale', '--output'))]
+
+	directory = tempfile.mkdtemp(prefix='reddit-l2-benchmark-')
+	try:
+		start = time.perf_counter()
+		fixtures = Fixtures(directory, scale)
+		setup = time.perf_counter() - start
+
+		report = {'scale': scale, 'python': sys.version.split()[0], 'cpus': mp.cpu_count(),
+				  'fixtures_seconds': round(setup, 4), 'stages': benchmark(fixtures, names)}
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+	# end try
+
+	print(json.dumps(report, indent=2))
+	if output is not None:
+		with open(output, 'w') as fout: json.dump(report, fout, indent=2)
+	# end if
+
+# end if
@@ -188,42 +188,48 @@ def exist_in_wordnet(etymology):
 PROB_THRESHOLD = 0.9
 SIGNIFICANCE_RATE = str(5)
 
-with open('vocab.pos.pkl', 'rb') as fin: vocab_pos = pickle.load(fin)
+# invocation: "python parse.etymology.py", in the directory of the etymology and vocabulary files
 
-print('uploading the etymology dataset...')
-etymology = upload_etymological_dataset('etymwn.etymology.rel.tsv')
-print('constructed etymology dictionary with', len(etymology.keys()), 'entries')
+if __name__ == '__main__':
 
-roots = extract_words_roots(etymology)
+	with open('vocab.pos.pkl', 'rb') as fin: vocab_pos = pickle.load(fin)
 
-print('reading dataset filtered vocabulary file...')
-vocab_filename = 'vocab.no.entities.pos.100.dat'
-vocabulary = read_vocabulary(vocab_filename)
-print('total words in vocabulary:', len(vocabulary.keys()))
+	print('uploading the etymology dataset...')
+	etymology = upload_etymological_dataset('etymwn.etymology.rel.tsv')
+	print('constructed etymology dictionary with', len(etymology.keys()), 'entries')
 
-synsets = generate_synsets(etymology, vocabulary, roots)
-print('generated', len(synsets), 'synsets with multiple words')
-print_synsets('synsets.mult.initial.100.dat', synsets)
+	roots = extract_words_roots(etymology)
 
-print('filtering out synsets with country specific lexicon...')
-SIGNIFICANT_WORDS = 'significant.words.' + SIGNIFICANCE_RATE + '.dat'
-synsets = filter_out_country_specific_lexicon(synsets, SIGNIFICANT_WORDS)
-print_synsets('synsets.mult.without.country.lex.100.dat', synsets)
+	print('reading dataset filtered vocabulary file...')
+	vocab_filename = 'vocab.no.entities.pos.100.dat'
+	vocabulary = read_vocabulary(vocab_filename)
+	print('total words in vocabulary:', len(vocabulary.keys()))
 
-print('filtering out synsets with extremely prevalent word(s)...')
-synsets = filter_out_synsets_with_prevalent_words(synsets, vocab_filename)
-print_synsets('synsets.mult.without.prev.100.dat', synsets)
+	synsets = generate_synsets(etymology, vocabulary, roots)
+	print('generated', len(synsets), 'synsets with multiple words')
+	print_synsets('synsets.mult.initial.100.dat', synsets)
 
-print('filtering out etymologically homogeneous sysnets...')
-synsets = filter_out_etymologically_homogeneous_synsets(synsets, roots)
-print_synsets('synsets.mult.final.100.dat', synsets)
+	print('filtering out synsets with country specific lexicon...')
+	SIGNIFICANT_WORDS = 'significant.words.' + SIGNIFICANCE_RATE + '.dat'
+	synsets = filter_out_country_specific_lexicon(synsets, SIGNIFICANT_WORDS)
+	print_synsets('synsets.mult.without.country.lex.100.dat', synsets)
 
+	print('filtering out synsets with extremely prevalent word(s)...')
+	synsets = filter_out_synsets_with_prevalent_words(synsets, vocab_filename)
+	print_synsets('synsets.mult.without.prev.100.dat', synsets)
 
-words = list()
-for synset in synsets: words.extend(synset)
+	print('filtering out etymologically homogeneous sysnets...')
+	synsets = filter_out_etymologically_homogeneous_synsets(synsets, roots)
+	print_synsets('synsets.mult.final.100.dat', synsets)
 
-with codecs.open('focused.set.' + SIGNIFICANCE_RATE + '.' + str(PROB_THRESHOLD) + '.dat', 'w', 'utf-8') as fout:
-	fout.write('\n'.join(list(set(words))) + '\n')
-# end with
 
-print('finished')
+	words = list()
+	for synset in synsets: words.extend(synset)
+
+	with codecs.open('focused.set.' + SIGNIFICANCE_RATE + '.' + str(PROB_THRESHOLD) + '.dat', 'w', 'utf-8') as fout:
+		fout.write('\n'.join(list(set(words))) + '\n')
+	# end with
+
+	print('finished')
+
+# end if
@@ -1,8 +1,12 @@
+import os
 import sys
-import time
-import pickle
+import codecs
+import itertools
 import collections
-from nltk import FreqDist
+import numpy as np
+import multiprocessing as mp
+
+from instrumentation import Stage
 
 
 class Utils:
@@ -27,29 +31,194 @@ class Utils:
 	# end def
 
 	@staticmethod
-	def divide_into_chunks(configuration):
-		labels = []
-		text_chunks = []
-
-		for entry in configuration:
-			print("loading", entry.chunks, "chunks from", entry.datafile)
-			with open(entry.datafile, 'r') as fin:
-				text = fin.read().strip()
-				tokens = text.split()
-
-				processed_chunks = 0
-				for i in range(0, len(tokens), CHUNK_SIZE):
-					text_chunks.append(' '.join(tokens[i:i + CHUNK_SIZE]).lower())
-					labels.append(entry.name)
-					processed_chunks += 1
-
-					if processed_chunks == int(entry.chunks):
-						break
-					# end if
-				# end for
-			# end with
+	def iterate_token_blocks(datafile, block_size=None):
+		'''
+		stream a data file in fixed-size blocks and yield the lowercased tokens of every block
+		a token that crosses a block boundary is carried over to the next block
+		:param datafile: text file to read
+		:param block_size: number of characters read at once
+		:return: generator of token lists
+		'''
+		block_size = block_size or BLOCK_SIZE
+		remainder = ''
+		with open(datafile, 'r') as fin:
+			while True:
+				block = fin.read(block_size)
+				if not block: break
+
+				tokens = (remainder + block).split()
+				remainder = tokens.pop() if not block[-1].isspace() else ''
+				yield list(map(str.lower, tokens))
+			# end while
+		# end with
+		if remainder: yield [remainder.lower()]
+	# end def
+
+	@staticmethod
+	def load_vocabulary_index(filename):
+		'''
+		map the vocabulary words to integer ids, in the order of the vocabulary file
+		:return: list of words and a word -> id dictionary
+		'''
+		words = Utils.load_words_list(filename)
+		index = {}
+		for i, word in enumerate(words): index.setdefault(word, i)
+		return words, index
+	# end def
+
+	@staticmethod
+	def token_ids(tokens, index, sentinel):
+		'''
+		map tokens to vocabulary ids, tokens outside the vocabulary map to the sentinel id
+		:return: array of ids
+		'''
+		return np.fromiter(map(index.get, tokens, itertools.repeat(sentinel)), dtype=np.int64, count=len(tokens))
+	# end def
+
+	@staticmethod
+	def count_vocabulary(datafile, index, size, chunks):
+		'''
+		count the occurrences of vocabulary words in every chunk of CHUNK_SIZE tokens, in a single pass
+		:param datafile: text file to read
+		:param index: word -> id dictionary
+		:param size: vocabulary size, ids are in [0, size)
+		:param chunks: maximal number of chunks to count
+		:return: (chunks x size) array of word counts, one row per (possibly partial) chunk read,
+		and the number of tokens of every chunk, out-of-vocabulary tokens included
+		'''
+		counts = np.zeros((chunks, size + 1), dtype=np.int64)  # last column counts out-of-vocabulary tokens
+		processed = 0
+		for tokens in Utils.iterate_token_blocks(datafile):
+			while tokens and processed < chunks * CHUNK_SIZE:
+				chunk = processed // CHUNK_SIZE
+				current = tokens[:(chunk + 1) * CHUNK_SIZE - processed]
+				counts[chunk] += np.bincount(Utils.token_ids(current, index, size), minlength=size + 1)
+
+				processed += len(current)
+				tokens = tokens[len(current):]
+			# end while
+			if processed == chunks * CHUNK_SIZE: break
 		# end for
-		return text_chunks, labels
+
+		read_chunks = -(-processed // CHUNK_SIZE)
+		return counts[:read_chunks, :size], counts[:read_chunks].sum(axis=1)
+	# end def
+
+# end class
+
+
+class CountMatrix:
+	'''
+	dense (countries x vocabulary) int64 word count matrix, stored as <prefix>.npy with
+	the row (country) and column (word) labels in <prefix>.rows.txt and <prefix>.cols.txt
+	optionally with (countries x chunks x vocabulary) per-chunk counts in <prefix>.chunks.npy,
+	where country i has nchunks[i] chunks (<prefix>.nchunks.npy) and the remaining rows are zeros,
+	and the token totals of the chunks and of the counts in <prefix>.chunk.tokens.npy and <prefix>.tokens.npy
+	'''
+	def __init__(self, counts, countries, words, chunk_counts=None, nchunks=None, chunk_tokens=None, tokens=None):
+		self.counts = counts
+		self.countries = list(countries)
+		self.words = list(words)
+		self.chunk_counts = chunk_counts
+		self.nchunks = nchunks
+		self.chunk_tokens = chunk_tokens
+		self.tokens = tokens
+		self.row_index = {country: i for i, country in enumerate(self.countries)}
+		self.column_index = {word: j for j, word in enumerate(self.words)}
+	# end def
+
+	def select(self, countries, words):
+		'''
+		slice the counts of the given countries and words, words outside the vocabulary count 0
+		:return: (countries x words) array of counts
+		'''
+		rows = [self.row_index[country] for country in countries]
+		columns = np.array([self.column_index.get(word, -1) for word in words], dtype=int)
+		found = columns >= 0
+
+		selected = np.zeros((len(rows), len(columns)), dtype=self.counts.dtype)
+		selected[:, found] = self.counts[np.ix_(rows, columns[found])]
+		return selected
+	# end def
+
+	def select_chunks(self, countries, words):
+		'''
+		slice the per-chunk counts of the given countries and words, words outside the vocabulary count 0
+		:return: (countries x chunks x words) array of counts and the number of chunks of every country
+		'''
+		rows = [self.row_index[country] for country in countries]
+		columns = np.array([self.column_index.get(word, -1) for word in words], dtype=int)
+		found = columns >= 0
+
+		selected = np.zeros((len(rows), self.chunk_counts.shape[1], len(columns)), dtype=self.chunk_counts.dtype)
+		selected[:, :, found] = self.chunk_counts[rows][:, :, columns[found]]
+		return selected, np.asarray(self.nchunks)[rows]
+	# end def
+
+	def select_tokens(self, countries):
+		'''
+		:return: (countries x chunks) token totals of the chunks and the token totals of the counts of
+		the given countries, or None and None for a matrix saved without them
+		'''
+		if self.chunk_tokens is None: return None, None
+		rows = [self.row_index[country] for country in countries]
+		return np.asarray(self.chunk_tokens)[rows], np.asarray(self.tokens)[rows]
+	# end def
+
+	def save(self, prefix):
+		# counts are stored as int64, the readers cast them where they need floats
+		for counts in (self.counts, self.chunk_counts):
+			if counts is not None and not np.issubdtype(np.asarray(counts).dtype, np.integer):
+				raise ValueError('count matrices hold integer counts, got ' + str(np.asarray(counts).dtype))
+			# end if
+		# end for
+		np.save(prefix + '.npy', np.asarray(self.counts, dtype=np.int64))
+		CountMatrix.save_labels(prefix + '.rows.txt', self.countries)
+		CountMatrix.save_labels(prefix + '.cols.txt', self.words)
+		if self.chunk_counts is not None:
+			np.save(prefix + '.chunks.npy', np.asarray(self.chunk_counts, dtype=np.int64))
+			np.save(prefix + '.nchunks.npy', self.nchunks)
+		# end if
+		if self.chunk_tokens is not None:
+			np.save(prefix + '.chunk.tokens.npy', self.chunk_tokens)
+			np.save(prefix + '.tokens.npy', self.tokens)
+		# end if
+	# end def
+
+	@staticmethod
+	def load(prefix, mmap_mode='r'):
+		'''
+		load a saved count matrix, memory-mapped by default
+		'''
+		counts = np.load(prefix + '.npy', mmap_mode=mmap_mode)
+		chunk_counts, nchunks = None, None
+		if os.path.exists(prefix + '.chunks.npy'):
+			chunk_counts = np.load(prefix + '.chunks.npy', mmap_mode=mmap_mode)
+			nchunks = np.load(prefix + '.nchunks.npy')
+		# end if
+		chunk_tokens, tokens = None, None
+		if os.path.exists(prefix + '.chunk.tokens.npy'):
+			chunk_tokens = np.load(prefix + '.chunk.tokens.npy')
+			tokens = np.load(prefix + '.tokens.npy')
+		# end if
+
+		countries = CountMatrix.load_labels(prefix + '.rows.txt')
+		words = CountMatrix.load_labels(prefix + '.cols.txt')
+		return CountMatrix(counts, countries, words, chunk_counts, nchunks, chunk_tokens, tokens)
+	# end def
+
+	@staticmethod
+	def save_labels(filename, labels):
+		with codecs.open(filename, 'w', 'utf-8') as fout:
+			for name in labels: fout.write(name + '\n')
+		# end with
+	# end def
+
+	@staticmethod
+	def load_labels(filename):
+		with codecs.open(filename, 'r', 'utf-8') as fin:
+			return [line.rstrip('\n') for line in fin]
+		# end with
 	# end def
 
 # end class
@@ -58,37 +227,54 @@ class Utils:
 class Classification:
 
 	@staticmethod
-	def create_features_map(cfg_filename, vocab_filename):
-		start = time.clock()
+	def create_features_map(cfg_filename, vocab_filename, processes=None):
 		configuration = Utils.parse_classification_configuration(cfg_filename)
-		text_chunks, labels = Utils.divide_into_chunks(configuration)
+		words_list, index = Utils.load_vocabulary_index(vocab_filename)
 
-		countries = [entry.name for entry in configuration]
+		# data files are counted in parallel, a country listed in several files gets the sum of their
+		# (first chunk) counts, and the chunks of all its files for the per-chunk counts; the token
+		# totals are kept with them, so that chunks of different lengths can be compared as rates
+		with Stage('count_vocabulary', unit='files') as stage, mp.Pool(processes or PROCESSES) as pool:
+			tasks = [(entry.datafile, index, len(words_list), int(entry.chunks)) for entry in configuration]
+			file_counts = pool.starmap(Utils.count_vocabulary, tasks)
+			stage.add(len(tasks))
+			for entry in configuration: stage.add_files(entry.datafile)
+		# end with
 
-		dictionary = {}
-		words_list = Utils.load_words_list(vocab_filename)
-		for country, chunk in zip(countries, text_chunks):
-			dcountry = {}
-			dist = FreqDist(chunk.split())
-			for word in words_list:
-				dcountry[word] = dist[word]
-			# end for
-			dictionary[country] = dcountry
+		country_counts, country_tokens = {}, {}
+		country_chunks, country_chunk_tokens = {}, {}
+		for entry, (counts, tokens) in zip(configuration, file_counts):
+			if len(counts) == 0: continue
+			country_counts[entry.name] = country_counts.get(entry.name, 0) + counts[0]
+			country_tokens[entry.name] = country_tokens.get(entry.name, 0) + tokens[0]
+			country_chunks.setdefault(entry.name, []).append(counts)
+			country_chunk_tokens.setdefault(entry.name, []).append(tokens)
 		# end for
 
-		with open('vocab.countries.pkl', 'wb') as fout:
-			pickle.dump(dictionary, fout, pickle.HIGHEST_PROTOCOL)
-		# end with
+		countries = list(country_counts.keys())
+		matrix = np.array([country_counts[country] for country in countries], dtype=np.int64).reshape(len(countries), len(words_list))
+		tokens = np.array([country_tokens[country] for country in countries], dtype=np.int64)
+
+		nchunks = np.array([sum(len(counts) for counts in country_chunks[country]) for country in countries], dtype=np.int64)
+		chunk_counts = np.zeros((len(countries), max(nchunks, default=0), len(words_list)), dtype=np.int64)
+		chunk_tokens = np.zeros((len(countries), max(nchunks, default=0)), dtype=np.int64)
+		for i, country in enumerate(countries):
+			chunk_counts[i, :nchunks[i]] = np.concatenate(country_chunks[country])
+			chunk_tokens[i, :nchunks[i]] = np.concatenate(country_chunk_tokens[country])
+		# end for
 
-		print('time:', '{0:.3f}'.format(time.clock() - start))
+		CountMatrix(matrix, countries, words_list, chunk_counts, nchunks, chunk_tokens, tokens).save(VOCAB_COUNTS_PREFIX)
 	# end def
 
 # end class
 
 
 CHUNK_SIZE = 2500000
+BLOCK_SIZE = 4194304  # characters read at once when streaming data files
+PROCESSES = mp.cpu_count()
 label = collections.namedtuple('label', ['datafile', 'name', 'chunks'])
 VOCAB_FILENAME = 'vocabulary.100.dat'
+VOCAB_COUNTS_PREFIX = 'vocab.countries'
 
 # invocation: "python extract_word_count.py data.reddit.voc.cfg"
 
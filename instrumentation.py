@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+
+'''
+stage-level instrumentation shared by the pipeline scripts: every stage reports its wall time, items (lines,
+words, pairs) and bytes read and written, with their rates, and the peak memory of the stage, as one JSON
+record per line; records go to the file named by the REDDIT_L2_LOG environment variable, stderr otherwise;
+setting REDDIT_L2_PROFILE to a stage name profiles that stage with cProfile (stats saved to <stage>.prof)
+'''
+
+LOG_VARIABLE = 'REDDIT_L2_LOG'
+PROFILE_VARIABLE = 'REDDIT_L2_PROFILE'
+PROGRESS_ITEMS = 100000  # items between progress records
+
+# peak resident memory (MB) of this process before the last reset_peak_rss, which also resets ru_maxrss
+_reset_peak = 0.0
+
+
+def peak_rss_mb():
+	'''
+	peak resident memory of this process and of its (waited for) children over their whole lifetime, in MB
+	'''
+	# ru_maxrss is in kilobytes on linux
+	peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	return max(round(peak / 1024.0, 1), _reset_peak)
+# end def
+
+
+def current_peak_rss_mb():
+	'''
+	peak resident memory of this process since the last reset_peak_rss (VmHWM), in MB, None if unknown
+	'''
+	try:
+		with open('/proc/self/status') as fin:
+			for line in fin:
+				if line.startswith('VmHWM:'): return round(int(line.split()[1]) / 1024.0, 1)
+			# end for
+		# end with
+	except (OSError, ValueError):
+		pass
+	# end try
+	return None
+# end def
+
+
+def reset_peak_rss():
+	'''
+	reset the peak resident memory of this process to its current resident memory (linux only)
+	:return: True if the peak was reset
+	'''
+	global _reset_peak
+	_reset_peak = max(_reset_peak, current_peak_rss_mb() or 0.0)
+	try:
+		with open('/proc/self/clear_refs', 'w') as fout: fout.write('5')
+		return True
+	except OSError:
+		return False
+	# end try
+# end def
+
+
+def log(record):
+	line = json.dumps(record, sort_keys=False)
+	filename = os.environ.get(LOG_VARIABLE)
+	if filename:
+		with open(filename, 'a') as fout: fout.write(line + '\n')
+	else:
+		sys.stderr.write(line + '\n')  # a single write, so that records of worker processes do not interleave
+	# end if
+# end def
+
+
+class Stage:
+	'''
+	context manager measuring a pipeline stage, e.g.,
+		with Stage('true_case', unit='lines') as stage:
+			for line in fin: ...; stage.add(1)
+			stage.add_files(filename, outfile)
+	a progress record is logged every progress items, a summary record when the stage ends;
+	peak_rss_mb is the peak memory of this process during the stage (the peak is reset when a stage starts,
+	enclosing stages keep their own), process_peak_rss_mb the lifetime peak of the process and its children
+	'''
+	active = []  # stages entered and not exited yet, innermost last
+	def __init__(self, name, unit='lines', progress=PROGRESS_ITEMS, **fields):
+		self.name = name
+		self.unit = unit
+		self.progress = progress
+		self.fields = fields
+		self.items = 0
+		self.bytes_read = 0
+		self.bytes_written = 0
+		self.next_progress = progress
+		self.profiler = None
+		self.peak = None
+	# end def
+
+	def __enter__(self):
+		if os.environ.get(PROFILE_VARIABLE) == self.name:
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		# end if
+		# the peak of the enclosing stages so far is kept before the reset
+		current = current_peak_rss_mb()
+		for stage in Stage.active: stage.peak = max(stage.peak or 0.0, current or 0.0)
+		self.peak = 0.0 if reset_peak_rss() else None
+		Stage.active.append(self)
+
+		self.start = time.perf_counter()
+		return self
+	# end def
+
+	def add(self, items=0, bytes_read=0, bytes_written=0):
+		self.items += items
+		self.bytes_read += bytes_read
+		self.bytes_written += bytes_written
+		if self.next_progress is not None and self.items >= self.next_progress:
+			self.next_progress += self.progress
+			log(self.record('progress'))
+		# end if
+	# end def
+
+	def add_files(self, infile=None, outfile=None):
+		# bytes of files processed as a whole
+		if infile is not None: self.bytes_read += os.path.getsize(infile)
+		if outfile is not None: self.bytes_written += os.path.getsize(outfile)
+	# end def
+
+	def record(self, event):
+		seconds = time.perf_counter() - self.start
+		record = {'event': event, 'stage': self.name, 'seconds': round(seconds, 3),
+				  self.unit: self.items, self.unit + '_per_second': round(self.items / seconds, 1) if seconds > 0 else None,
+				  'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+				  'mb_per_second': round((self.bytes_read + self.bytes_written) / 1048576.0 / seconds, 2) if seconds > 0 else None,
+				  'peak_rss_mb': max(self.peak, current_peak_rss_mb() or 0.0) if self.peak is not None else None,
+				  'process_peak_rss_mb': peak_rss_mb()}
+		record.update(self.fields)
+		return record
+	# end def
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		record = self.record('stage' if exc_type is None else 'failed')
+		if self in Stage.active: Stage.active.remove(self)
+		if self.profiler is not None:
+			self.profiler.disable()
+			record['profile'] = self.name + '.prof'
+			self.profiler.dump_stats(record['profile'])
+		# end if
+		log(record)
+	# end def
+# end class
+
@@ -1,33 +1,14 @@
-import sys, math
+import os, sys, math
 import numpy as np
 import multiprocessing as mp
 import itertools
-import pickle
 
-from numpy import linalg as LA
-from scipy.spatial.distance import cityblock
+from multiprocessing import shared_memory
 
+from scipy.spatial.distance import cityblock, squareform
 
-def load_obj(name):
-	with open(name, 'rb') as fin: return pickle.load(fin)
-# end def
-
-
-def get_facets(filename):
-	facets = {}
-	file = open(filename)
-
-	for line in file:
-		cols = line.rstrip().split(" ")
-		facets[cols[0]] = 1
-	# end for
-	file.close()
-
-	# don't count the base facet
-	del facets["MAIN"]
-
-	return facets.keys()
-# end def
+from extract_word_count import CountMatrix
+from instrumentation import Stage
 
 
 def normalize_dist(freq_dist):
@@ -43,66 +24,170 @@ def normalize_dist(freq_dist):
 # end def
 
 
-def normalize(embeddings):
-	for name in embeddings:
-		for word in embeddings[name]:
-			a = embeddings[name][word]
-			norm = LA.norm(a, 2)
-			a /= norm
-
-			embeddings[name][word] = a
-		# end for
-	# end for
+def normalize_rows(matrix):
+	'''
+	unit-normalize every row of a (words x dim) matrix in bulk
+	'''
+	# row-wise np.inner keeps the norms bit-identical to np.linalg.norm(a, 2) of every single vector
+	norms = np.sqrt(np.matmul(matrix[:, np.newaxis, :], matrix[:, :, np.newaxis])[:, 0, 0])
+	matrix /= norms[:, np.newaxis]
+	return matrix
 # end def
 
 
-def parse_embeddings(filename):
+def parse_embeddings(filename, facets=None, words=None):
+	'''
+	read the facet embeddings in a single streaming pass over the file; lines of facets or words
+	that are not requested are skipped before any float conversion
+	:param filename: text embeddings file, lines of "<facet> <word> <values>"
+	:param facets: optional allow-list of facets, all facets but MAIN by default
+	:param words: optional allow-list of words, e.g., the focused vocabulary
+	:return: facet -> {word: unit-normalized vector} dictionary
+	'''
+	facets = set(facets) if facets is not None else None
+	words = set(words) if words is not None else None
+
+	base = {}
+	deviations = {}
+	with open(filename) as file:
+		for line in file:
+			cols = line.rstrip().split(" ", 2)
+			if len(cols) < 3: continue # corrupted line
+			facet, word = cols[0], cols[1]
+
+			if facet == "MAIN":
+				target = base
+			else:
+				if facets is not None and facet not in facets: continue
+				target = deviations.setdefault(facet, {})
+			# end if
+
+			if words is not None and word not in words: continue
+			vals = cols[2].split(" ")
+			if len(vals) < 8: continue # corrupted line
+
+			embedding_array = np.array(vals, dtype=float)
+			target[word] = target[word] + embedding_array if word in target else embedding_array
+		# end for
+	# end with
+
+	# state embeddings for a word = the MAIN embedding for that word *plus* the state-specific deviation
+	# "wicked" in MA = wicked/MAIN + wicked/MA
 	embeddings = {}
-	file = open(filename)
+	for facet, deviation in deviations.items():
+		facet_words = list(base.keys()) + [word for word in deviation if word not in base]
+		if not facet_words:
+			embeddings[facet] = {}
+			continue
+		# end if
 
-	facets = get_facets(filename)
-	# if you want to only consider a few metadata facets and not all, do that below
-	#facets = ['France', 'Italy']
+		size = len(next(iter(base.values())) if base else next(iter(deviation.values())))
+		matrix = np.zeros((len(facet_words), size))
+		for n, word in enumerate(facet_words):
+			if word in base: matrix[n] += base[word]
+			if word in deviation: matrix[n] += deviation[word]
+		# end for
 
-	for facet in facets:
-		embeddings[facet] = {}
+		embeddings[facet] = dict(zip(facet_words, normalize_rows(matrix)))
 	# end for
 
-	for line in file:
-		cols = line.rstrip().split(" ")
-		if len(cols) < 10: continue # corrupted line
-		facet = cols[0]
-
-		if facet != "MAIN" and facet not in embeddings: continue
+	return embeddings
 
-		word = cols[1]
-		vals = cols[2:]
-		embedding_array = np.array(vals, dtype=float)
-		size = len(vals)
+# end def
 
-		# state embeddings for a word = the MAIN embedding for that word *plus* the state-specific deviation
-		# "wicked" in MA = wicked/MAIN + wicked/MA
 
-		if facet == "MAIN":
-			for n in embeddings:
-				if word not in embeddings[n]:
-					embeddings[n][word] = np.zeros(size)
-				# end if
-			# end for
-				embeddings[n][word] += embedding_array
-		else:
-			if word not in embeddings[facet]:
-				embeddings[facet][word] = np.zeros(size)
+def convert_embeddings(filename, store_dir):
+	'''
+	one-time conversion of a text embeddings file into a binary store that can be memory-mapped:
+	facets.npy and words.npy (sorted) label arrays, and vectors.npy with a float64 (words x dim) matrix
+	per facet, where MAIN is already folded in and the vectors are L2-normalized exactly as parse_embeddings
+	does; the file is streamed twice, first for the labels, then to accumulate the vectors directly into
+	the memory-mapped store, so only the MAIN matrix and a single facet matrix are ever held in memory
+	:param filename: text embeddings file, as read by parse_embeddings
+	:param store_dir: output directory
+	'''
+	facets, words, size = set(), set(), 0
+	with open(filename) as file:
+		for line in file:
+			cols = line.rstrip().split(" ", 2)
+			if len(cols) < 3: continue # corrupted line
+			if cols[0] != "MAIN": facets.add(cols[0])
+			if cols[2].count(" ") + 1 < 8: continue # corrupted line, as in parse_embeddings
+			words.add(cols[1])
+			size = size or cols[2].count(" ") + 1
+		# end for
+	# end with
+	facets, words = sorted(facets), sorted(words)
+	facet_index = {facet: f for f, facet in enumerate(facets)}
+	word_index = {word: w for w, word in enumerate(words)}
+
+	if not os.path.exists(store_dir): os.makedirs(store_dir)
+	np.save(os.path.join(store_dir, 'facets.npy'), np.array(facets, dtype=str))
+	np.save(os.path.join(store_dir, 'words.npy'), np.array(words, dtype=str))
+
+	# the deviations are summed in place in the (zero-filled) store, MAIN is kept aside
+	vectors = np.lib.format.open_memmap(os.path.join(store_dir, 'vectors.npy'), mode='w+',
+					dtype=np.float64, shape=(len(facets), len(words), size))
+	present = np.zeros((len(facets), len(words)), dtype=bool)
+	base = np.zeros((len(words), size))
+	in_base = np.zeros(len(words), dtype=bool)
+	with open(filename) as file:
+		for line in file:
+			cols = line.rstrip().split(" ", 2)
+			if len(cols) < 3: continue # corrupted line
+			vals = cols[2].split(" ")
+			if len(vals) < 8: continue # corrupted line
+
+			w = word_index[cols[1]]
+			if cols[0] == "MAIN":
+				base[w] += np.array(vals, dtype=float)
+				in_base[w] = True
+			else:
+				f = facet_index[cols[0]]
+				vectors[f, w] += np.array(vals, dtype=float)
+				present[f, w] = True
 			# end if
-			embeddings[facet][word] += embedding_array
-		# end if
+		# end for
+	# end with
+
+	# state embeddings for a word = the MAIN embedding for that word *plus* the state-specific deviation
+	for f in range(len(facets)):
+		present[f] |= in_base
+		vectors[f, present[f]] = normalize_rows(base[present[f]] + vectors[f, present[f]])
 	# end for
+	vectors.flush()
+
+	np.save(os.path.join(store_dir, 'present.npy'), present)
+# end def
 
-	file.close()
 
-	normalize(embeddings)
-	return embeddings
+def load_embedding_store(store_dir, words, countries):
+	'''
+	memory-map a store written by convert_embeddings and read only the requested facets and words
+	:return: (countries x words x dim) tensor and (countries x words) mask, as returned by stack_embeddings
+	'''
+	facets = np.load(os.path.join(store_dir, 'facets.npy'))
+	vocabulary = np.load(os.path.join(store_dir, 'words.npy'), mmap_mode='r')
+	vectors = np.load(os.path.join(store_dir, 'vectors.npy'), mmap_mode='r')
+	stored = np.load(os.path.join(store_dir, 'present.npy'), mmap_mode='r')
+
+	facet_index = {facet: f for f, facet in enumerate(facets)}
+	rows = [facet_index[country] for country in countries]
+
+	# words.npy is sorted, look the focused words up with a binary search
+	words = np.array(words, dtype=str)
+	positions = np.searchsorted(vocabulary, words)
+	found = positions < len(vocabulary)
+	found[found] = vocabulary[positions[found]] == words[found]
+
+	tensor = np.zeros((len(countries), len(words), vectors.shape[2]))
+	present = np.zeros((len(countries), len(words)), dtype=bool)
+	for c, row in enumerate(rows):
+		tensor[c, found] = vectors[row, positions[found]]
+		present[c, found] = stored[row, positions[found]]
+	# end for
 
+	return tensor, present
 # end def
 
 
@@ -168,6 +253,359 @@ def compute_pairwise_euclidean_embed_similarity(embeddings, words, country_dist,
 # end def
 
 
+def stack_embeddings(embeddings, words, countries):
+	'''
+	stack the (unit-normalized) facet embeddings of the focused words into a single tensor
+	:param embeddings: facet -> {word: vector} dictionary, as returned by parse_embeddings
+	:param words: focused vocabulary
+	:param countries: facets to stack, in the row order of the resulting distance matrix
+	:return: (countries x words x dim) tensor and (countries x words) mask of words with an embedding
+	'''
+	size = next((len(vector) for country in countries for vector in embeddings[country].values()), 0)
+	tensor = np.zeros((len(countries), len(words), size))
+	present = np.zeros((len(countries), len(words)), dtype=bool)
+
+	for c, country in enumerate(countries):
+		facet = embeddings[country]
+		for w, word in enumerate(words):
+			if word not in facet: continue
+			tensor[c, w] = facet[word]
+			present[c, w] = True
+		# end for
+	# end for
+
+	return tensor, present
+# end def
+
+
+def stack_word_counts(country_dist, words, countries):
+	'''
+	stack the per-country word counts of the focused words
+	:param country_dist: country -> {word: count} dictionary
+	:return: (countries x words) array of counts
+	'''
+	counts = np.zeros((len(countries), len(words)))
+	for c, country in enumerate(countries):
+		counts[c] = [country_dist[country].get(word, 0) for word in words]
+	# end for
+	return counts
+# end def
+
+
+def stack_word_weights(norm_dist, words):
+	'''
+	normalized collection frequency of every focused word (nan for words missing from the collection)
+	'''
+	return np.array([norm_dist.get(word, np.nan) for word in words], dtype=float)
+# end def
+
+
+def pair_cosines(tensor, row, cols):
+	'''
+	cosine of every focused word between a single country and a set of countries
+	:return: (cols x words) array of cosines
+	'''
+	# batched np.inner: matmul of (1 x dim) by (dim x 1) keeps the dot product bit-identical
+	return np.matmul(tensor[cols][:, :, np.newaxis, :], tensor[row][:, :, np.newaxis])[:, :, 0, 0]
+# end def
+
+
+def score_words(tensor, present, counts, weights, row, cols, cosine=None):
+	'''
+	per-word scores of a single country against a set of countries, equivalent to
+	compute_pairwise_euclidean_embed_similarity for every (row, col) pair at once
+	:param row: index of the first country of every pair
+	:param cols: indices of the second country of every pair
+	:param cosine: optional precomputed pair_cosines(tensor, row, cols)
+	:return: (cols x words) scores and a mask of the scores that enter the mean
+	'''
+	if cosine is None: cosine = pair_cosines(tensor, row, cols)
+	dist = np.abs(counts[row] - counts[cols])  # manhattan distance of scalar counts
+	valid = present[row] & present[cols] & ~np.isnan(weights)
+
+	zero = (cosine == 1.0) | (dist == 0.0)  # due to math.pow() exception
+	with np.errstate(invalid='ignore', divide='ignore'):
+		scores = np.power(1.0 - cosine, weights) * np.power(dist, 1.0 - weights)
+	# end with
+	scores[zero] = 0.0
+
+	# math.pow() raises ValueError for a negative base with a fractional exponent, such words are skipped
+	valid &= zero | ~((cosine > 1.0) & (weights != np.floor(weights)))
+
+	return scores, valid
+# end def
+
+
+def compute_distance_block(tensor, present, counts, weights, rows, cols):
+	'''
+	mean word score for every pair in rows x cols, with the same semantics
+	as compute_pairwise_similarity_multiprocess for a single pair
+	:return: (rows x cols) array of distances
+	'''
+	cols = np.asarray(cols, dtype=int)
+	block = np.full((len(rows), len(cols)), np.nan)
+
+	for n, row in enumerate(rows):
+		block[n] = mean_scores(*score_words(tensor, present, counts, weights, row, cols))
+	# end for
+
+	return block
+# end def
+
+
+def mean_scores(scores, valid):
+	'''
+	mean of the valid word scores of every pair, nan for pairs without any valid word
+	'''
+	found = valid.sum(axis=-1)
+	total = np.where(valid, scores, 0.0).sum(axis=-1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(found > 0, total / found, np.nan)
+	# end with
+# end def
+
+
+def compute_word_scores(tensor, present, counts, weights):
+	'''
+	per-word scores of every pair, in condensed order; distances of word resamplings of the
+	focused vocabulary follow from these with resampled_distances, without touching the embeddings
+	:return: (pairs x words) scores, zero where not valid, and the (pairs x words) validity mask
+	'''
+	size = len(tensor)
+	scores, valid = [], []
+	for row in range(size - 1):
+		row_scores, row_valid = score_words(tensor, present, counts, weights, row, np.arange(row + 1, size))
+		scores.append(np.where(row_valid, row_scores, 0.0))
+		valid.append(row_valid)
+	# end for
+	return np.concatenate(scores), np.concatenate(valid)
+# end def
+
+
+def resampled_distances(scores, valid, multiplicities):
+	'''
+	distances of word resamplings: the mean of the valid word scores of every pair, each word weighted by
+	the number of times it was drawn, so a replicate costs two matrix products
+	:param scores: (pairs x words) scores of compute_word_scores
+	:param valid: (pairs x words) validity mask of compute_word_scores
+	:param multiplicities: (replicates x words) number of times every word is drawn in every replicate
+	:return: (replicates x pairs) condensed distances, nan for pairs without any valid drawn word
+	'''
+	found = np.matmul(multiplicities, valid.T.astype(float))
+	total = np.matmul(multiplicities, scores.T)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(found > 0, total / found, np.nan)
+	# end with
+# end def
+
+
+def save_word_scores(filename, countries, scores, valid):
+	np.savez(filename, names=np.array(countries), scores=scores, valid=valid)
+# end def
+
+
+def load_word_scores(filename):
+	with np.load(filename) as data:
+		return list(data['names']), data['scores'], data['valid']
+	# end with
+# end def
+
+
+def bootstrap_distance_intervals(tensor, present, chunk_counts, nchunks, weights, replicates=1000, alpha=0.05, seed=None,
+								 chunk_tokens=None, tokens=None):
+	'''
+	bootstrap confidence intervals of the condensed distances from per-chunk word counts: every replicate
+	resamples the chunks of each country with replacement and scores the pairs with the mean chunk counts
+	:param chunk_counts: (countries x chunks x words) counts, country i has nchunks[i] chunks
+	:param chunk_tokens: optional (countries x chunks) token totals of the chunks, with which the chunks are
+	resampled as word rates, so that a (trailing) partial chunk weighs as much as a full one, and the mean
+	rates are scaled to tokens, the (countries) token totals of the point estimate counts
+	:param alpha: the intervals cover 1-alpha of the bootstrap distribution
+	:return: lower and upper condensed vectors, and the (replicates x pairs) bootstrap distances
+	'''
+	rng = np.random.default_rng(seed)
+	size = len(tensor)
+
+	# the embeddings do not change across replicates, only the counts do
+	rows = [(row, np.arange(row + 1, size)) for row in range(size - 1)]
+	cosines = [pair_cosines(tensor, row, cols) for row, cols in rows]
+
+	if chunk_tokens is None:
+		rates, scale = chunk_counts.astype(float), np.ones(size)
+	else:
+		rates, scale = chunk_counts / np.maximum(chunk_tokens, 1)[:, :, None], tokens
+	# end if
+
+	samples = np.empty((replicates, size * (size - 1) // 2))
+	for r in range(replicates):
+		counts = np.empty(chunk_counts.shape[::2])
+		for c in range(size):
+			picks = rng.integers(0, nchunks[c], nchunks[c])
+			counts[c] = rates[c, picks].mean(axis=0) * scale[c]
+		# end for
+
+		offset = 0
+		for (row, cols), cosine in zip(rows, cosines):
+			samples[r, offset:offset + len(cols)] = mean_scores(*score_words(tensor, present, counts, weights, row, cols, cosine))
+			offset += len(cols)
+		# end for
+	# end for
+
+	with np.errstate(invalid='ignore'):
+		lower, upper = np.nanpercentile(samples, [50.0 * alpha, 100.0 - 50.0 * alpha], axis=0)
+	# end with
+	return lower, upper, samples
+# end def
+
+
+# arrays published by SharedDistancePool, attached once per worker process
+_shared_arrays = {}
+_shared_segments = []
+
+
+def _attach_shared_arrays(layout):
+	for name, (segment_name, shape, dtype) in layout.items():
+		segment = shared_memory.SharedMemory(name=segment_name)
+		_shared_segments.append(segment)
+		_shared_arrays[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+	# end for
+# end def
+
+
+def _compute_shared_block(task):
+	rows, cols = task
+	arrays = _shared_arrays
+	return rows, compute_distance_block(arrays['tensor'], arrays['present'], arrays['counts'], arrays['weights'], rows, cols)
+# end def
+
+
+class SharedDistancePool:
+	'''
+	long-lived process pool scoring blocks of country pairs; the stacked embeddings, counts and weights
+	are published once through shared memory instead of being pickled into every worker
+	'''
+	def __init__(self, tensor, present, counts, weights, processes=None):
+		self.processes = processes or mp.cpu_count()
+		self.segments = []
+
+		layout = {}
+		for name, array in (('tensor', tensor), ('present', present), ('counts', counts), ('weights', weights)):
+			array = np.ascontiguousarray(array)
+			segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+			np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+			self.segments.append(segment)
+			layout[name] = (segment.name, array.shape, array.dtype.str)
+		# end for
+
+		self.pool = mp.Pool(self.processes, initializer=_attach_shared_arrays, initargs=(layout,))
+	# end def
+
+	def compute_block(self, rows, cols):
+		'''
+		distances for every pair in rows x cols, rows are split into blocks spread over the workers
+		:return: (rows x cols) array of distances
+		'''
+		rows = list(rows)
+		cols = list(cols)
+		block = np.full((len(rows), len(cols)), np.nan)
+		if not rows or not cols: return block
+
+		rows_per_task = max(1, len(rows) // (4 * self.processes))
+		tasks = [(rows[k:k + rows_per_task], cols) for k in range(0, len(rows), rows_per_task)]
+
+		position = {row: n for n, row in enumerate(rows)}
+		for task_rows, distances in self.pool.imap_unordered(_compute_shared_block, tasks):
+			block[[position[row] for row in task_rows]] = distances
+		# end for
+
+		return block
+	# end def
+
+	def compute_rows(self, tasks):
+		'''
+		distances for rows that each come with their own columns, e.g., the upper triangle of the matrix
+		:param tasks: list of (row, cols) tuples
+		:return: dictionary row -> distances to its cols
+		'''
+		tasks = [([row], list(cols)) for row, cols in tasks if len(cols) > 0]
+		return {rows[0]: distances[0] for rows, distances in self.pool.imap_unordered(_compute_shared_block, tasks)}
+	# end def
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+		for segment in self.segments:
+			segment.close()
+			segment.unlink()
+		# end for
+	# end def
+
+	def __enter__(self):
+		return self
+	# end def
+
+	def __exit__(self, *args):
+		self.close()
+	# end def
+# end class
+
+
+def compute_condensed_distances(tensor, present, counts, weights, countries, previous=None, processes=1):
+	'''
+	compute only the upper triangle of the (symmetric) distance matrix, as a condensed distance vector
+	that can be passed to scipy.cluster.hierarchy.linkage directly
+	:param countries: facet names, in the row order of the stacked arrays
+	:param previous: optional (names, condensed) of a previously saved matrix, only the pairs
+	                 involving countries missing from it are computed
+	:param processes: number of worker processes, None for all CPUs, 1 to compute in this process
+	:return: condensed distance vector
+	'''
+	matrix = np.full((len(countries), len(countries)), np.nan)
+	np.fill_diagonal(matrix, 0.0)
+
+	if previous is not None:
+		names, condensed = previous
+		index = {name: n for n, name in enumerate(names)}
+		kept = [c for c, country in enumerate(countries) if country in index]
+		old = [index[countries[c]] for c in kept]
+		matrix[np.ix_(kept, kept)] = squareform(condensed, checks=False)[np.ix_(old, old)]
+	# end if
+
+	tasks = []
+	for row in range(len(countries)):
+		cols = [col for col in range(row + 1, len(countries)) if np.isnan(matrix[row, col])]
+		if cols: tasks.append((row, cols))
+	# end for
+
+	if processes == 1:
+		rows = {row: compute_distance_block(tensor, present, counts, weights, [row], cols)[0] for row, cols in tasks}
+	else:
+		with SharedDistancePool(tensor, present, counts, weights, processes) as pool:
+			rows = pool.compute_rows(tasks)
+		# end with
+	# end if
+
+	for row, cols in tasks:
+		matrix[row, cols] = rows[row]
+		matrix[cols, row] = rows[row]
+	# end for
+
+	return squareform(matrix, checks=False)
+# end def
+
+
+def save_condensed_distances(filename, countries, condensed):
+	np.savez(filename, names=np.array(countries), distances=condensed)
+# end def
+
+
+def load_condensed_distances(filename):
+	with np.load(filename) as data:
+		return list(data['names']), data['distances']
+	# end with
+# end def
+
+
 def load_word_counts(vocab_filename):
 	freq_dist = dict()
 	with open(vocab_filename, 'r') as fin:
@@ -180,28 +618,85 @@ def load_word_counts(vocab_filename):
 
 
 FOCUSED_VOCABULARY = 'focused.dat'
-VOCAB_FREQUENCY_FILENAME = 'vocab.countries.pkl'
+VOCAB_COUNTS_PREFIX = 'vocab.countries'
 FULL_VOCABULARY_FILENAME = 'vocabulary.100.dat'
+CONDENSED_DISTANCES_FILENAME = 'pairwise.distance.npz'
+BOOTSTRAP_FILENAME = 'pairwise.distance.bootstrap.npz'
+BOOTSTRAP_REPLICATES = 1000
+WORD_SCORES_FILENAME = 'pairwise.word.scores.npz'
+EMBEDDINGS_FILENAME = 'out.embeddings'
+EMBEDDINGS_STORE = 'out.embeddings.store'
+PROCESSES = mp.cpu_count()
+
+# invocation: "python pairwise_distance.py [--incremental] [--convert] [--bootstrap] [--word-scores]"
+# with --incremental only the countries (facets) missing from the saved condensed matrix are computed
+# with --convert the text embeddings are first converted into a binary store, used by all later runs
+# with --bootstrap confidence intervals are estimated from the per-chunk counts of extract_word_count.py
+# with --word-scores the per-word scores of all pairs are saved, for the bootstrap trees of phylogenetic_tree.py
 
 if __name__ == "__main__":
 
-	country_dist = load_obj(VOCAB_FREQUENCY_FILENAME)
+	count_matrix = CountMatrix.load(VOCAB_COUNTS_PREFIX)
 	freq_dist = load_word_counts(FULL_VOCABULARY_FILENAME)
 	norm_dist = normalize_dist(freq_dist)
 
 	with open(FOCUSED_VOCABULARY) as fin: words = [word.strip() for word in fin]
 	with open('countries.dat') as fin: countries = [country.strip() for country in fin]
 
-	emb_filename = 'out.embeddings'
-	embeddings = parse_embeddings(emb_filename)
+	if '--convert' in sys.argv:
+		with Stage('convert_embeddings') as stage:
+			convert_embeddings(EMBEDDINGS_FILENAME, EMBEDDINGS_STORE)
+			stage.add_files(EMBEDDINGS_FILENAME)
+		# end with
+	# end if
+
+	previous = None
+	if '--incremental' in sys.argv and os.path.exists(CONDENSED_DISTANCES_FILENAME):
+		previous = load_condensed_distances(CONDENSED_DISTANCES_FILENAME)
+	# end if
 
 	#print('loaded data, computing similarities...')
-	for l1 in itertools.product(countries, countries):
-		sim = compute_pairwise_similarity_multiprocess(embeddings, words, country_dist, norm_dist, l1[0], l1[1])
+	with Stage('load_embeddings', unit='vectors') as stage:
+		if os.path.isdir(EMBEDDINGS_STORE):
+			tensor, present = load_embedding_store(EMBEDDINGS_STORE, words, countries)
+		else:
+			embeddings = parse_embeddings(EMBEDDINGS_FILENAME, countries, words)
+			tensor, present = stack_embeddings(embeddings, words, countries)
+			stage.add_files(EMBEDDINGS_FILENAME)
+		# end if
+		stage.add(int(present.sum()))
+	# end with
+	counts = count_matrix.select(countries, words).astype(float)
+	weights = stack_word_weights(norm_dist, words)
+
+	with Stage('pairwise_distances', unit='pairs') as stage:
+		condensed = compute_condensed_distances(tensor, present, counts, weights, countries, previous, PROCESSES)
+		save_condensed_distances(CONDENSED_DISTANCES_FILENAME, countries, condensed)
+		stage.add(len(condensed))
+		stage.add_files(outfile=CONDENSED_DISTANCES_FILENAME)
+	# end with
 
-		print(l1[0], l1[1], 'distance:', sim)
-		sys.stdout.flush()
+	if '--bootstrap' in sys.argv:
+		with Stage('bootstrap', unit='replicates') as stage:
+			chunk_counts, nchunks = count_matrix.select_chunks(countries, words)
+			chunk_tokens, tokens = count_matrix.select_tokens(countries)
+			lower, upper, _ = bootstrap_distance_intervals(tensor, present, chunk_counts, nchunks, weights, BOOTSTRAP_REPLICATES,
+														   chunk_tokens=chunk_tokens, tokens=tokens)
+			np.savez(BOOTSTRAP_FILENAME, names=np.array(countries), lower=lower, upper=upper)
+			stage.add(BOOTSTRAP_REPLICATES)
+		# end with
+	# end if
+
+	if '--word-scores' in sys.argv:
+		scores, valid = compute_word_scores(tensor, present, counts, weights)
+		save_word_scores(WORD_SCORES_FILENAME, countries, scores, valid)
+	# end if
+
+	distances = squareform(condensed)
+	for (i, l1_1), (j, l1_2) in itertools.product(enumerate(countries), enumerate(countries)):
+		print(l1_1, l1_2, 'distance:', distances[i, j])
 	# end for
+	sys.stdout.flush()
 
 
 # end if
@@ -1,78 +1,365 @@
-import math
+import os
+import sys
+import json
+import functools
+import collections
 import numpy as np
+import multiprocessing as mp
 from sklearn import preprocessing
 from sklearn.preprocessing import StandardScaler
-from scipy.cluster.hierarchy import dendrogram, linkage
+from scipy.cluster.hierarchy import dendrogram, linkage, to_tree
+from scipy.spatial.distance import squareform
 import matplotlib.pyplot as plt
 from pylab import rcParams
 
+from instrumentation import Stage
+from pairwise_distance import resampled_distances, load_word_scores, WORD_SCORES_FILENAME
+
+
+# too little data or non-IE languages
+IGNORE_COUNTRIES = [
+    'Estonia', 'Georgia', 'Armenia', 'Hungary', 'Moldova', 'Malta', 'Turkey', 'China',
+    'Cyprus', 'India', 'Israel', 'Belgium', 'Greece', 'Switzerland', 'Finland',
+    'Albania', 'Macedonia', 'Montenegro']
+LINKAGE_METHODS = ['ward']
+
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_BATCH = 50  # replicates per worker task
+CONSENSUS_FILENAME = 'consensus.tree.nwk'
+
+RENDER_FORMATS = ['png', 'svg', 'nwk']
+RENDER_CACHE_SIZE = 16  # distance matrices kept loaded by every rendering worker
+
+# (scores, valid) of the selected pairs, set in every bootstrap worker by init_bootstrap
+_word_scores = None
+# cached load_distances of the rendering workers
+_distances = None
+
 
 def verify_symmetric(X):
-    for i in range(0, X.shape[0]):
-        for j in range(0, X.shape[1]):
-            if X[i][j] != X[j][i]: print('very very bad...')
-        # end for
-    # end for
+    if not np.array_equal(X, X.T): print('very very bad...')
 # end def
 
 
 def flat_distances(X):
-    flat_dist_vec = []
-    for i in range(0, X.shape[0]):
-        for j in range(i + 1, X.shape[1]):
-            flat_dist_vec.append(X[i][j])
+    # upper triangle of the (symmetric) matrix, in the order linkage expects
+    return squareform(X, checks=False)
+# end def
+
+
+def load_distances(filename):
+    '''
+    load a full pairwise distance matrix, from the "c1 c2 distance: d" text output of pairwise_distance.py
+    or from its condensed .npz matrix (names and distances)
+    :param filename: text or .npz file
+    :return: sorted names and (names x names) distance matrix
+    '''
+    if filename.endswith('.npz'):
+        with np.load(filename) as data:
+            names, condensed = list(data['names']), data['distances']
+        # end with
+        order = np.argsort(names)
+        matrix = squareform(condensed, checks=False)[np.ix_(order, order)]
+        return [str(names[i]) for i in order], matrix
+    # end if
+
+    with open(filename) as fin:
+        fields = np.array(fin.read().split()).reshape(-1, 4)
+    # end with
+    names, rows = np.unique(fields[:, 0], return_inverse=True)
+    cols = np.searchsorted(names, fields[:, 1])
+
+    matrix = np.zeros((len(names), len(names)))
+    matrix[rows, cols] = fields[:, 3].astype(float)
+    return [str(name) for name in names], matrix
+# end def
+
+
+def select_leaves(names, matrix, leaves=None, ignore=None):
+    '''
+    :param leaves: optional names to keep, all names by default
+    :param ignore: optional names to leave out
+    :return: selected names and their distance matrix
+    '''
+    keep = [i for i, name in enumerate(names) if (leaves is None or name in leaves) and (ignore is None or name not in ignore)]
+    return [names[i] for i in keep], matrix[np.ix_(keep, keep)]
+# end def
+
+
+def distance_matrix(filename, ignore=IGNORE_COUNTRIES):
+    names, matrix = select_leaves(*load_distances(filename), ignore=ignore)
+    verify_symmetric(matrix)
+
+    flat_distances_vec = flat_distances(matrix)
+    return flat_distances_vec, names
+
+# end def
+
+
+def build_trees(filename, methods=LINKAGE_METHODS, subsets=None, load=load_distances):
+    '''
+    build the trees of several linkage methods and leaf subsets over a single load of the distance matrix
+    :param filename: distance matrix, see load_distances
+    :param methods: linkage methods, e.g., 'ward', 'average', 'complete'
+    :param subsets: dict of subset name to (leaves, ignore), see select_leaves; IGNORE_COUNTRIES by default
+    :param load: function loading the distance matrix, e.g., a cached load_distances
+    :return: dict of (subset name, method) to (linkage matrix, leaf names)
+    '''
+    if subsets is None: subsets = {'default': (None, IGNORE_COUNTRIES)}
+    names, matrix = load(filename)
+
+    trees = {}
+    for subset, (leaves, ignore) in subsets.items():
+        subset_names, subset_matrix = select_leaves(names, matrix, leaves, ignore)
+        verify_symmetric(subset_matrix)
+        dist = flat_distances(subset_matrix)
+        for method in methods:
+            trees[(subset, method)] = (linkage(dist, method=method, metric='euclidean'), subset_names)
         # end for
     # end for
+    return trees
+# end def
 
-    if len(flat_dist_vec) != (X.shape[0] * (X.shape[1] - 1) / 2): print('wrong flat vector size...')
 
-    return flat_dist_vec
+def select_pairs(names, leaves=None, ignore=None):
+    '''
+    :return: selected names and the positions of their pairs in the condensed order of all names
+    '''
+    keep = [i for i, name in enumerate(names) if (leaves is None or name in leaves) and (ignore is None or name not in ignore)]
+    positions = squareform(np.arange(1, len(names) * (len(names) - 1) // 2 + 1), checks=False)
+    return [names[i] for i in keep], squareform(positions[np.ix_(keep, keep)], checks=False) - 1
 # end def
 
 
-def distance_matrix(filename):
-    names = list()
-    distances = list()
+def tree_clades(lm, names):
+    '''
+    :return: set of the clades of a linkage tree as frozensets of leaf names, single leaves and the root excluded
+    '''
+    members = [frozenset([name]) for name in names]
+    for left, right in lm[:, :2].astype(int): members.append(members[left] | members[right])
+    return set(members[len(names):-1])
+# end def
 
-    # too little data or non-IE languages
-    ignore_countries = [
-        'Estonia', 'Georgia', 'Armenia', 'Hungary', 'Moldova', 'Malta', 'Turkey', 'China',
-        'Cyprus', 'India', 'Israel', 'Belgium', 'Greece', 'Switzerland', 'Finland',
-        'Albania', 'Macedonia', 'Montenegro']
 
-    with open(filename) as fin:
-        for line in fin:
-            split_line = line.strip().split()
-            orig_name = split_line[0]
-            targ_name = split_line[1]
+def init_bootstrap(scores, valid):
+    # once per bootstrap worker, and in the parent process when the trees are built there
+    global _word_scores
+    _word_scores = (scores, valid)
+# end def
+
 
-            if orig_name in ignore_countries or targ_name in ignore_countries: continue
+def bootstrap_clades(task):
+    '''
+    build the trees of a batch of word resamplings
+    :param task: (seed sequence, number of replicates, linkage method, leaf names)
+    :return: counter of the clades and the number of replicates that could be built
+    '''
+    seed, replicates, method, names = task
+    scores, valid = _word_scores
+    rng = np.random.default_rng(seed)
 
-            distances.append(float(split_line[3]))  # *100)
-            names.append(orig_name)
+    # number of times each focused word is drawn, as drawing len(words) words with replacement
+    words = scores.shape[1]
+    multiplicities = rng.multinomial(words, np.full(words, 1.0 / words), size=replicates).astype(float)
+
+    clades = collections.Counter()
+    built = 0
+    for dist in resampled_distances(scores, valid, multiplicities):
+        if not np.isfinite(dist).all(): continue  # a pair without any drawn word
+        clades.update(tree_clades(linkage(dist, method=method, metric='euclidean'), names))
+        built += 1
+    # end for
+    return clades, built
+# end def
+
+
+def bootstrap_consensus(names, scores, valid, replicates=BOOTSTRAP_REPLICATES, method='ward',
+                        leaves=None, ignore=IGNORE_COUNTRIES, processes=None, seed=None):
+    '''
+    majority-rule consensus of the trees of bootstrap resamplings of the focused vocabulary
+    :param names: countries, in the order of the word scores
+    :param scores: (pairs x words) scores of pairwise_distance.compute_word_scores
+    :param valid: (pairs x words) validity mask of pairwise_distance.compute_word_scores
+    :param leaves: optional names to keep, all names by default
+    :param ignore: optional names to leave out
+    :param processes: number of worker processes, None for all CPUs, 1 to build the trees in this process
+    :return: consensus newick string, dict of clade to support, number of replicates built
+    '''
+    names, pairs = select_pairs(names, leaves, ignore)
+    scores, valid = scores[pairs], valid[pairs]
+
+    batches = [BOOTSTRAP_BATCH] * (replicates // BOOTSTRAP_BATCH) + ([replicates % BOOTSTRAP_BATCH] if replicates % BOOTSTRAP_BATCH else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    tasks = [(task_seed, batch, method, names) for task_seed, batch in zip(seeds, batches)]
+    if processes == 1:
+        init_bootstrap(scores, valid)
+        results = [bootstrap_clades(task) for task in tasks]
+    else:
+        # the scores are passed to the workers explicitly, so that spawned (not forked) workers get them too
+        with mp.Pool(processes, initializer=init_bootstrap, initargs=(scores, valid)) as pool:
+            results = pool.map(bootstrap_clades, tasks)
+        # end with
+    # end if
+
+    clades = collections.Counter()
+    for batch_clades, _ in results: clades.update(batch_clades)
+    built = sum(batch_built for _, batch_built in results)
+    if built == 0: raise ValueError('none of the {0} bootstrap replicates could be built'.format(replicates))
+
+    support = {clade: count / float(built) for clade, count in clades.items()}
+    return consensus_newick(names, support), support, built
+# end def
+
+
+def consensus_newick(names, support, threshold=0.5):
+    '''
+    newick string of the majority-rule consensus tree, every internal node labeled with its support
+    :param support: dict of clade (frozenset of names) to the fraction of trees it appears in
+    :param threshold: clades appearing in more than this fraction of the trees are kept
+    '''
+    order = {name: i for i, name in enumerate(names)}
+    # clades of more than half of the trees are compatible, largest first so that the children are maximal
+    clades = sorted((clade for clade, value in support.items() if value > threshold), key=len, reverse=True)
+
+    def newick(clade):
+        children = []
+        covered = set()
+        for sub in clades:
+            if sub < clade and not (sub & covered):
+                children.append(sub)
+                covered |= sub
+            # end if
         # end for
-    # end with
+        children.extend(frozenset([name]) for name in clade - covered)
+        children.sort(key=lambda child: min(order[name] for name in child))
+
+        rendered = [next(iter(child)) if len(child) == 1 else newick(child) + '{0:.2f}'.format(support[child]) for child in children]
+        return '(' + ','.join(rendered) + ')'
+    # end def
+
+    return newick(frozenset(names)) + ';'
+# end def
+
 
-    # print(len(similarity))
-    dim = int(math.sqrt(len(distances)))
-    distance_matrix = np.reshape(np.array(distances), (dim, dim))
-    verify_symmetric(distance_matrix)
+def linkage_newick(lm, names):
+    '''
+    newick string of a linkage tree, with branch lengths
+    '''
+    def newick(node, height):
+        length = ':{0:.6f}'.format(height - node.dist)
+        if node.is_leaf(): return names[node.id] + length
+        return '(' + newick(node.get_left(), node.dist) + ',' + newick(node.get_right(), node.dist) + ')' + length
+    # end def
+
+    root = to_tree(lm)
+    return '(' + newick(root.get_left(), root.dist) + ',' + newick(root.get_right(), root.dist) + ');'
+# end def
 
-    flat_distances_vec = flat_distances(distance_matrix)
-    return flat_distances_vec, sorted(list(set(names)))
 
+def init_renderer():
+    # once per rendering worker: non-interactive backend, figure defaults and the matrix cache
+    global _distances
+    plt.switch_backend('Agg')
+    rcParams['figure.figsize'] = 10, 5
+    _distances = functools.lru_cache(maxsize=RENDER_CACHE_SIZE)(load_distances)
+# end def
+
+
+def render_tree(task):
+    '''
+    build and render a single tree
+    :param task: (job, output dir); a job is a dict with 'name' (output file name without extension),
+                 'matrix' (distance matrix file, see load_distances) and the optional 'method' ('ward'),
+                 'leaves' (all), 'ignore' (IGNORE_COUNTRIES) and 'formats' (RENDER_FORMATS)
+    :return: the written files
+    '''
+    job, out_dir = task
+    method = job.get('method', 'ward')
+    trees = build_trees(job['matrix'], [method], {job['name']: (job.get('leaves'), job.get('ignore', IGNORE_COUNTRIES))},
+                        load=_distances or load_distances)
+    lm, names = trees[(job['name'], method)]
+
+    outfiles = []
+    formats = job.get('formats', RENDER_FORMATS)
+    prefix = os.path.join(out_dir, job['name'])
+    if 'nwk' in formats:
+        with open(prefix + '.nwk', 'w') as fout: fout.write(linkage_newick(lm, names) + '\n')
+        outfiles.append(prefix + '.nwk')
+    # end if
+
+    images = [fmt for fmt in formats if fmt != 'nwk']
+    if images:
+        figure = plt.figure()
+        dendrogram(lm, leaf_rotation=90, leaf_font_size=10, labels=names, color_threshold=0.65*max(lm[:, 2]), ax=figure.gca())
+        figure.tight_layout()
+        for fmt in images:
+            figure.savefig(prefix + '.' + fmt, format=fmt)
+            outfiles.append(prefix + '.' + fmt)
+        # end for
+        plt.close(figure)
+    # end if
+    return outfiles
+# end def
+
+
+def render_batch(jobs, out_dir='', processes=None):
+    '''
+    render the trees of many distance matrices and leaf subsets in parallel, without a display
+    :param jobs: list of jobs, see render_tree
+    :param out_dir: output files dir
+    :param processes: number of worker processes, all CPUs by default
+    :return: the written files of every job, in the order of the jobs
+    '''
+    if out_dir: os.makedirs(out_dir, exist_ok=True)
+    with mp.Pool(processes, initializer=init_renderer) as pool:
+        return pool.map(render_tree, [(job, out_dir) for job in jobs], chunksize=1)
+    # end with
 # end def
 
 
 rcParams['figure.figsize'] = 10, 5
 
+# invocation: "python phylogenetic_tree.py [--methods <method,...>] [--bootstrap] [--batch <jobs.json> [<output dir>]]"
+# by default the trees of LINKAGE_METHODS (or of the comma-separated --methods) are shown, one figure per method
+# with --batch the trees of a json list of jobs (see render_tree) are rendered to files, without a display
+# with --bootstrap the majority-rule consensus of BOOTSTRAP_REPLICATES word resamplings is written to
+# CONSENSUS_FILENAME, from the word scores saved by "python pairwise_distance.py --word-scores"
+
 if __name__ == '__main__':
 
-    filename = 'pairwise.distance.out'
-    dist, names = distance_matrix(filename)
+    if '--bootstrap' in sys.argv:
+        with Stage('bootstrap_consensus', unit='replicates') as stage:
+            consensus, _, built = bootstrap_consensus(*load_word_scores(WORD_SCORES_FILENAME))
+            stage.add(built)
+        # end with
+        with open(CONSENSUS_FILENAME, 'w') as fout: fout.write(consensus + '\n')
+        print(consensus)
+        if '--batch' not in sys.argv: sys.exit(0)
+    # end if
 
-    lm = linkage(dist, method='ward', metric='euclidean')
-    dn = dendrogram(lm, leaf_rotation=90, leaf_font_size=10, labels=names, color_threshold=0.65*max(lm[:, 2]))
+    if '--batch' in sys.argv:
+        args = sys.argv[sys.argv.index('--batch') + 1:]
+        with open(args[0]) as fin: jobs = json.load(fin)
+        with Stage('render_trees', unit='trees') as stage:
+            for outfiles in render_batch(jobs, args[1] if len(args) > 1 else ''):
+                stage.add(1)
+                for outfile in outfiles: stage.add_files(outfile=outfile)
+            # end for
+        # end with
+        sys.exit(0)
+    # end if
+
+    filename = 'pairwise.distance.out'
+    methods = sys.argv[sys.argv.index('--methods') + 1].split(',') if '--methods' in sys.argv else LINKAGE_METHODS
+    with Stage('build_tree', unit='trees') as stage:
+        trees = build_trees(filename, methods)
+        stage.add(len(trees))
+        stage.add_files(filename)
+    # end with
+    for (subset, method), (lm, names) in trees.items():
+        plt.figure(method)
+        dn = dendrogram(lm, leaf_rotation=90, leaf_font_size=10, labels=names, color_threshold=0.65*max(lm[:, 2]))
+    # end for
     #print(len(names))
     plt.show()
 
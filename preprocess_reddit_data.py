@@ -1,8 +1,23 @@
 import os
+import bz2
 import glob
+import gzip
+import json
+import lzma
+import math
+import array
+import random
 import codecs
+import shutil
+import functools
+import itertools
+import collections
+import numpy as np
+import multiprocessing as mp
 from polyglot.detect import Detector
 
+from instrumentation import Stage, log
+
 
 class Parsing:
 	@staticmethod
@@ -14,7 +29,7 @@ class Parsing:
 		'''
 		try:
 			detector = Detector(text)
-		except:
+		except Exception:
 			# the detector could not identify the language
 			# typically extremely short non-alphabetic sentences
 			return False
@@ -35,6 +50,17 @@ class Parsing:
 			   token.startswith('r/') or token.startswith('u/')
 	# end def
 
+	@staticmethod
+	def url_cleanup_line(line):
+		'''
+		sustitute links in a line with 'URL' token
+		:param line:
+		:return: line without links
+		'''
+		tokens = [token if not Parsing.is_web_link(token) else 'URL' for token in line.strip().split()]
+		return ' '.join(tokens)
+	# end def
+
 	@staticmethod
 	def perform_url_cleanup(input_dir):
 		'''
@@ -42,18 +68,21 @@ class Parsing:
 		:param input_dir:
 		:return:
 		'''
-		for filename in sorted(glob.glob(input_dir + '*')): # can specify pattern
-			outfile = filename + '.out'
+		with Stage('perform_url_cleanup') as stage:
+			for filename in sorted(glob.glob(input_dir + '*')): # can specify pattern
+				outfile = filename + '.out'
 
-			with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
-				print('processing', filename)
-				for line in fin:
-					# replace all urls with 'URL' token
-					tokens = [token if not Parsing.is_web_link(token) else 'URL' for token in line.strip().split()]
-					fout.write(' '.join(tokens) + '\n') # write down the line
-				# end for
-			# end with
-		# end for
+				with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
+					print('processing', filename)
+					for line in fin:
+						# replace all urls with 'URL' token
+						fout.write(Parsing.url_cleanup_line(line) + '\n') # write down the line
+						stage.add(1)
+					# end for
+				# end with
+				stage.add_files(filename, outfile)
+			# end for
+		# end with
 	# end def
 
 	@staticmethod
@@ -66,73 +95,232 @@ class Parsing:
 		'''
 		return text.find(substr, text.find(substr) + 1)
 	# end def
+
+	@staticmethod
+	def parse_metadata(line):
+		'''
+		split a line into its metadata and text in a single left-to-right scan
+		:param line: '[author] [subreddit] text' line
+		:return: (author, subreddit, text) tuple, None if the line has no metadata
+		'''
+		line = line.strip()
+		author_end = line.find(']')
+		start = line.find('[', author_end + 1)
+		end = line.find(']', start + 1)
+		if author_end < 0 or start < 0 or end < 0: return None
+		return line[1:author_end], line[start + 1:end].strip(), line[end + 2:]
+	# end def
+
+	@staticmethod
+	def load_subreddits(filename):
+		'''
+		:param filename: subreddit allow-list, one subreddit per line
+		:return: set of subreddits
+		'''
+		with codecs.open(filename, 'r', 'utf-8') as fin:
+			return set(line.strip() for line in fin if line.strip())
+		# end with
+	# end def
+
+	@staticmethod
+	def load_subreddit_countries(filename):
+		'''
+		:param filename: subreddit to country mapping, '<subreddit> <country>' per line
+		:return: dict of subreddit to country
+		'''
+		with codecs.open(filename, 'r', 'utf-8') as fin:
+			return dict(line.split() for line in fin if len(line.split()) == 2)
+		# end with
+	# end def
 # end class
 
 
+# n-gram frequencies of the true casing workers, inherited from the parent process when forked
+_frequencies = None
+_casing = None
+TRUE_CASE_MANIFEST = 'truecase.manifest.json'
+CASING_CACHE_SIZE = 1048576
+
+LANGUAGE_CACHE_SIZE = 1048576  # distinct lines with a cached language decision
+LANGUAGE_BATCH_SIZE = 10000  # lines sent to the language detection pool at once
+LANGUAGE_CHUNK_SIZE = 500
+ENGLISH_MIN_WORDS = 5  # shortest line accepted as English without the detector
+ENGLISH_WORDS_RATE = 0.9  # rate of known English words in such lines
+
+WEB_LINK_PREFIXES = ('http:', 'https:', 'r/', 'u/')
+
+ROUTER_BUFFER_LINES = 10000
+PARTITION_FILENAME = 'reddit.{}.txt.tok'
+LINE_COUNTS_FILENAME = 'reddit.line.counts'
+
+SAMPLE_SIZE = 1000000
+SAMPLE_SEED = 1
+SAMPLE_SUFFIX = '.shf.1M'
+
+
 class SimpleTrueCasing:
 	@staticmethod
-	def true_case(input_dir):
+	def true_case_line(line, casing):
+		'''
+		apply true case on a single line
+		:param line:
+		:param casing: CachedCasing over the n-gram frequencies
+		:return: true cased line
+		'''
+		line = line.strip()
+		if len(line.split()) == 1 and line.islower() and line.isalpha():
+			return line.capitalize()
+		# end if
+
+		out_tokens = []
+		split_line = line.split()
+		for i, token in enumerate(split_line):
+			# if it's first or last token
+			if i == 0 or i == len(split_line) - 1 or not token.islower():
+				out_tokens.append(token)
+				continue
+			# end if
+
+			# we have left- and right-tokens, check trigram frequency
+			out_tokens.append(casing.case_token(split_line[i - 1], token, split_line[i + 1]))
+		# end for
+		return ' '.join(out_tokens)
+	# end def
+
+	@staticmethod
+	def choose_case(token, f_current, f_capitalize, f_upper):
+		'''
+		pick the most frequent casing of a (lowercase) token
+		:return: the token, capitalized token or uppercase token
+		'''
+		f_max = max([f_current, f_capitalize, f_upper])
+		if f_max == f_current:
+			return token
+		elif f_max == f_capitalize:
+			return token.capitalize()
+		else:  # f_max == f_upper
+			return token.upper()
+		# end if
+	# end def
+
+	@staticmethod
+	def true_case(input_dir, frequencies=None):
 		'''
 		apply tru case on the reddit text -- lower, upper, or c title case
 		the case is determined according the maximum likelihood of a trigram, where the token is in the middle
 		:param input_dir:
+		:param frequencies: n-gram frequencies, loaded with Frequency.load by default
 		:return:
 		'''
-		trigram_freq, unigram_freq = Frequency.load_frequencies()
-		for filename in sorted(glob.glob(input_dir + '*')):
-			outfile = filename + '.tc'  # true case
+		with Stage('load_frequencies'):
+			casing = CachedCasing(frequencies or Frequency.load())
+		# end with
 
-			with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
-				print('processing', filename)
-				for line in fin:
-					line = line.strip()
-					if len(line.split()) == 1 and line.islower() and line.isalpha():
-						fout.write(line.capitalize() + '\n')
-						continue
-					# end if
+		with Stage('true_case') as stage:
+			for filename in sorted(glob.glob(input_dir + '*')):
+				outfile = filename + '.tc'  # true case
 
-					out_tokens = []
-					split_line = line.split()
-					for i, token in enumerate(split_line):
-						# if it's first or last token
-						if i == 0 or i == len(split_line) - 1 or not token.islower():
-							out_tokens.append(token)
-							continue
-						# end if
+				with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
+					print('processing', filename)
+					for line in fin:
+						fout.write(SimpleTrueCasing.true_case_line(line, casing) + '\n')
+						stage.add(1)
+					# end for
+				# end with
+				stage.add_files(filename, outfile)
+				casing.report(filename)
+			# end for
+		# end with
+	# end def
 
-						# we have left- and right-tokens, check trigram frequency
-						f_current = int(trigram_freq.get(' '.join([split_line[i - 1], token, split_line[i + 1]]), 0))
-						f_capitalize = int(trigram_freq.get(' '.join([split_line[i - 1], token.capitalize(), split_line[i + 1]]), 0))
-						f_upper = int(trigram_freq.get(' '.join([split_line[i - 1], token.upper(), split_line[i + 1]]), 0))
-						f_max = max([f_current, f_capitalize, f_upper])
-
-						if f_max == 0:  # no trigram containing the token found, fall back to unigrams
-							f_current = int(unigram_freq.get(token, 0))
-							f_capitalize = int(unigram_freq.get(token.capitalize(), 0))
-							f_upper = int(unigram_freq.get(token.upper(), 0))
-							f_max = max([f_current, f_capitalize, f_upper])
-						# end if
+	@staticmethod
+	def true_case_file(filename):
+		'''
+		true case a single file into <file>.tc, through a temporary <file>.tc.part so that
+		an interrupted run never leaves a partial output behind
+		:param filename:
+		:return: the input filename
+		'''
+		outfile = filename + '.tc'  # true case
+		with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile + '.part', 'w', 'utf-8') as fout:
+			print('processing', filename)
+			for line in fin:
+				fout.write(SimpleTrueCasing.true_case_line(line, _casing) + '\n')
+			# end for
+		# end with
+		os.replace(outfile + '.part', outfile)
+		_casing.report(filename)
+		return filename
+	# end def
 
-						if f_max == f_current:
-							out_tokens.append(token)
-							continue
-						elif f_max == f_capitalize:
-							out_tokens.append(token.capitalize())
-							continue
-						else:  # f_max == f_upper
-							out_tokens.append(token.upper())
-							continue
-						# end if
-					# end for
-					fout.write(' '.join(out_tokens) + '\n')
-				# end for
-			# end with
+	@staticmethod
+	def init_worker(ngrams_dir, index_dir):
+		# spawned (not forked) workers get neither the loaded frequencies nor the n-gram directories of __main__
+		global _frequencies, _casing, NGRAMS_DIR, NGRAMS_INDEX_DIR
+		NGRAMS_DIR, NGRAMS_INDEX_DIR = ngrams_dir, index_dir
+		if _frequencies is None: _frequencies = Frequency.load()
+		_casing = CachedCasing(_frequencies)
+	# end def
+
+	@staticmethod
+	def true_case_parallel(input_dir, processes=None):
+		'''
+		true case the files of the input directory concurrently, the n-gram frequencies are loaded once
+		and shared with forked workers, spawned workers load them again; completed files are recorded in a manifest (input size and
+		modification time) and skipped on rerun, .tc outputs are never taken as inputs
+		:param input_dir:
+		:param processes: number of worker processes, all CPUs by default
+		:return:
+		'''
+		global _frequencies
+		manifest_filename = input_dir + TRUE_CASE_MANIFEST
+		manifest = {}
+		if os.path.exists(manifest_filename):
+			with open(manifest_filename) as fin: manifest = json.load(fin)
+		# end if
+
+		pending = []
+		for filename in sorted(glob.glob(input_dir + '*')):
+			if filename == manifest_filename or filename.endswith(('.tc', '.tc.part')): continue
+			stat = os.stat(filename)
+			done = manifest.get(os.path.basename(filename))
+			if done == [stat.st_size, stat.st_mtime] and os.path.exists(filename + '.tc'): continue
+			pending.append(filename)
 		# end for
+		if not pending: return
+
+		with Stage('load_frequencies'):
+			_frequencies = Frequency.load()
+		# end with
+
+		with Stage('true_case', unit='files') as stage, \
+				mp.Pool(processes, initializer=SimpleTrueCasing.init_worker, initargs=(NGRAMS_DIR, NGRAMS_INDEX_DIR)) as pool:
+			for filename in pool.imap_unordered(SimpleTrueCasing.true_case_file, pending):
+				stat = os.stat(filename)
+				manifest[os.path.basename(filename)] = [stat.st_size, stat.st_mtime]
+
+				with open(manifest_filename + '.part', 'w') as fout: json.dump(manifest, fout, indent=1)
+				os.replace(manifest_filename + '.part', manifest_filename)
+				stage.add(1)
+				stage.add_files(filename, filename + '.tc')
+			# end for
+		# end with
 	# end def
 # end class
 
 
 class Frequency:
+	@staticmethod
+	def load():
+		'''
+		load the n-gram frequencies used for true casing: the memory-mapped index built by
+		Frequency.build_index if it exists, the COCA text files otherwise
+		:return: NgramIndex or FrequencyTables
+		'''
+		if os.path.isdir(NGRAMS_INDEX_DIR): return NgramIndex(NGRAMS_INDEX_DIR)
+		return FrequencyTables(*Frequency.load_frequencies())
+	# end def
+
 	@staticmethod
 	def load_frequencies():
 		'''
@@ -165,144 +353,869 @@ class Frequency:
 		# end with
 		return trigram_freq, unigram_freq
 	# end def
+
+	@staticmethod
+	def build_index(ngrams_dir, index_dir):
+		'''
+		one-time conversion of the COCA w3.txt and w2.txt files into a compact index that NgramIndex memory-maps:
+		a sorted vocabulary, the unigram frequencies (as counted by load_frequencies), and the sorted
+		integer keys of the trigrams (word ids packed into a single int64) with their counts
+		:param ngrams_dir: directory with the COCA n-gram files
+		:param index_dir: output directory
+		:return:
+		'''
+		word_ids = {}
+		unigrams = array.array('q')
+		keys, counts = array.array('q'), array.array('q')
+
+		def word_id(word):
+			if word not in word_ids:
+				word_ids[word] = len(word_ids)
+				unigrams.append(0)
+			# end if
+			return word_ids[word]
+		# end def
+
+		trigrams = []
+		with codecs.open(ngrams_dir + 'w3.txt', 'r', 'utf-8') as fin:
+			for line in fin:
+				fields = line.strip().split()
+				if len(fields) < 4: continue  # we expect 4 fields
+				ids = [word_id(fields[i]) for i in range(1, 4)]
+				for i in ids: unigrams[i] += 1
+				trigrams.extend(ids)
+				counts.append(int(fields[0]))
+			# end for
+		# end with
+
+		with codecs.open(ngrams_dir + 'w2.txt', 'r', 'utf-8') as fin:
+			for line in fin:
+				fields = line.strip().split()
+				if len(fields) < 3: continue  # we expect 3 fields
+				for i in range(1, 3): unigrams[word_id(fields[i])] += 1
+			# end for
+		# end with
+
+		size = len(word_ids)
+		if size ** 3 >= 2 ** 63: raise ValueError('vocabulary too large to pack trigrams into int64 keys')
+
+		# renumber the words in sorted order, so that ids can be found by binary search over the vocabulary
+		vocabulary = np.array(list(word_ids.keys()), dtype=str)
+		order = np.argsort(vocabulary, kind='stable')
+		rank = np.empty(size, dtype=np.int64)
+		rank[order] = np.arange(size)
+
+		trigrams = rank[np.array(trigrams, dtype=np.int64).reshape(-1, 3)]
+		keys = (trigrams[:, 0] * size + trigrams[:, 1]) * size + trigrams[:, 2]
+		counts = np.array(counts, dtype=np.int64)
+
+		# a trigram listed more than once keeps its last count, as in load_frequencies
+		order_keys = np.argsort(keys, kind='stable')
+		keys, counts = keys[order_keys], counts[order_keys]
+		last = np.append(keys[1:] != keys[:-1], True)
+
+		if not os.path.exists(index_dir): os.makedirs(index_dir)
+		np.save(os.path.join(index_dir, 'vocabulary.npy'), vocabulary[order])
+		np.save(os.path.join(index_dir, 'unigrams.npy'), np.array(unigrams, dtype=np.int64)[order])
+		np.save(os.path.join(index_dir, 'trigram.keys.npy'), keys[last])
+		np.save(os.path.join(index_dir, 'trigram.counts.npy'), counts[last])
+	# end def
+# end class
+
+
+class FrequencyTables:
+	'''
+	n-gram frequency lookups over the dictionaries of Frequency.load_frequencies
+	'''
+	def __init__(self, trigram_freq, unigram_freq):
+		self.trigram_freq = trigram_freq
+		self.unigram_freq = unigram_freq
+	# end def
+
+	def trigram_counts(self, left, tokens, right):
+		return [int(self.trigram_freq.get(' '.join([left, token, right]), 0)) for token in tokens]
+	# end def
+
+	def unigram_counts(self, tokens):
+		return [int(self.unigram_freq.get(token, 0)) for token in tokens]
+	# end def
+# end class
+
+
+class CachedCasing:
+	'''
+	casing decisions over n-gram frequencies, memoized in bounded LRU caches: the chosen casing
+	of a token per (left, token, right) context, and the unigram fallback decision per token
+	'''
+	def __init__(self, frequencies, maxsize=CASING_CACHE_SIZE):
+		self.frequencies = frequencies
+		self.case_token = functools.lru_cache(maxsize=maxsize)(self.decide)
+		self.case_unigram = functools.lru_cache(maxsize=maxsize)(self.decide_unigram)
+		self.reported = (0, 0, 0, 0)
+	# end def
+
+	def decide(self, left, token, right):
+		variants = [token, token.capitalize(), token.upper()]
+		counts = self.frequencies.trigram_counts(left, variants, right)
+		if max(counts) == 0:  # no trigram containing the token found, fall back to unigrams
+			return self.case_unigram(token)
+		# end if
+		return SimpleTrueCasing.choose_case(token, *counts)
+	# end def
+
+	def decide_unigram(self, token):
+		variants = [token, token.capitalize(), token.upper()]
+		return SimpleTrueCasing.choose_case(token, *self.frequencies.unigram_counts(variants))
+	# end def
+
+	def report(self, filename):
+		'''
+		log the cache hits and misses since the previous report
+		'''
+		context, unigram = self.case_token.cache_info(), self.case_unigram.cache_info()
+		current = (context.hits, context.misses, unigram.hits, unigram.misses)
+		hits, misses, unigram_hits, unigram_misses = [now - before for now, before in zip(current, self.reported)]
+		self.reported = current
+		log({'event': 'casing_cache', 'file': filename, 'context_hits': hits, 'context_misses': misses,
+			 'unigram_hits': unigram_hits, 'unigram_misses': unigram_misses})
+	# end def
+# end class
+
+
+class NgramIndex:
+	'''
+	memory-mapped n-gram frequency index written by Frequency.build_index; word ids are resolved
+	through a dictionary built once from the vocabulary, so that a lookup costs a few hash probes and
+	a single binary search over the trigram keys
+	'''
+	def __init__(self, index_dir):
+		vocabulary = np.load(os.path.join(index_dir, 'vocabulary.npy'))
+		self.ids = {word: i for i, word in enumerate(vocabulary.tolist())}
+		# plain ndarray views of the memory maps, indexing a np.memmap per lookup is noticeably slower
+		self.unigrams = np.asarray(np.load(os.path.join(index_dir, 'unigrams.npy'), mmap_mode='r'))
+		self.keys = np.asarray(np.load(os.path.join(index_dir, 'trigram.keys.npy'), mmap_mode='r'))
+		self.counts = np.asarray(np.load(os.path.join(index_dir, 'trigram.counts.npy'), mmap_mode='r'))
+		self.size = len(vocabulary)
+	# end def
+
+	def word_ids(self, words):
+		'''
+		:return: list of word ids, -1 for words out of the vocabulary
+		'''
+		return [self.ids.get(word, -1) for word in words]
+	# end def
+
+	def trigram_counts(self, left, tokens, right):
+		'''
+		:return: counts of the (left, token, right) trigrams, 0 for trigrams that are not listed
+		'''
+		left, right = self.ids.get(left, -1), self.ids.get(right, -1)
+		counts = [0] * len(tokens)
+		if left < 0 or right < 0: return counts
+
+		known = [(n, (left * self.size + i) * self.size + right) for n, i in enumerate(self.word_ids(tokens)) if i >= 0]
+		if len(known) == 0: return counts
+
+		positions = self.keys.searchsorted([key for n, key in known]).tolist()
+		for (n, key), position in zip(known, positions):
+			if position < len(self.keys) and self.keys[position] == key: counts[n] = int(self.counts[position])
+		# end for
+		return counts
+	# end def
+
+	def unigram_counts(self, tokens):
+		'''
+		:return: unigram frequencies of the tokens, 0 for tokens out of the vocabulary
+		'''
+		return [int(self.unigrams[i]) if i >= 0 else 0 for i in self.word_ids(tokens)]
+	# end def
+# end class
+
+
+class SubredditRouter:
+	'''
+	route the text of '[author] [subreddit] text' lines to per-subreddit (or per-country) output files in one pass;
+	texts are buffered per output file and the number of lines written to each file is kept in counts
+	'''
+	def __init__(self, routes, buffer_lines=ROUTER_BUFFER_LINES, keep_metadata=False):
+		'''
+		:param routes: dict of subreddit to output filename, several subreddits may share a file
+		:param buffer_lines: lines buffered per output file before writing
+		:param keep_metadata: write the whole lines rather than their text
+		'''
+		self.routes = routes
+		self.buffer_lines = buffer_lines
+		self.keep_metadata = keep_metadata
+		self.buffers = {outfile: [] for outfile in set(routes.values())}
+		self.files = {outfile: codecs.open(outfile, 'w', 'utf-8') for outfile in self.buffers}
+		self.counts = collections.Counter()
+	# end def
+
+	def route(self, lines):
+		for line in lines:
+			parsed = Parsing.parse_metadata(line)
+			if parsed is None: continue
+			outfile = self.routes.get(parsed[1])
+			if outfile is None: continue
+
+			buffer = self.buffers[outfile]
+			buffer.append(line.strip() if self.keep_metadata else parsed[2])
+			if len(buffer) >= self.buffer_lines: self.flush(outfile)
+		# end for
+	# end def
+
+	def flush(self, outfile):
+		buffer = self.buffers[outfile]
+		if not buffer: return
+		self.files[outfile].write('\n'.join(buffer) + '\n')
+		self.counts[outfile] += len(buffer)
+		del buffer[:]
+	# end def
+
+	def close(self):
+		for outfile in self.files:
+			self.flush(outfile)
+			self.files[outfile].close()
+		# end for
+	# end def
+
+	def __enter__(self):
+		return self
+	# end def
+
+	def __exit__(self, *args):
+		self.close()
+	# end def
 # end class
 
 
 class Utils:
 	@staticmethod
-	def extract_european_data(input_dir_name, out_dir_name):
+	def extract_european_data(input_dir_name, out_dir_name, subreddits=None):
 		'''
 		extract posts and comments submitted to the european subreddits
 		:param input_dir_name: input files dir
 		:param out_dir_name: output files dir
+		:param subreddits: subreddits to extract, EUROPEAN_SUBREDDITS by default
 		:return:
 		'''
+		if subreddits is None: subreddits = EUROPEAN_SUBREDDITS
 		for filename in sorted(glob.glob(input_dir_name + '*.tok')):
 			outfile = out_dir_name + os.path.basename(filename)
 
-			with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
+			routes = dict.fromkeys(subreddits, outfile)
+			with codecs.open(filename, 'r', 'utf-8') as fin, SubredditRouter(routes) as router:
 				print('processing', filename)
-				for line in fin:
-					start = Parsing.find_2nd_occurrence(line.strip(), '[')
-					end = Parsing.find_2nd_occurrence(line.strip(), ']')
-					subreddit = line[start + 1:end].strip()
-					# print(subreddit)
-
-					if subreddit not in EUROPEAN_SUBREDDITS: continue
-					text = line.strip()[end + 2:]
-					fout.write(text + '\n')
-				# end for
+				router.route(fin)
 			# end with
 		# end for
 	# end def
 
 	@staticmethod
-	def perform_cleanup(input_dir):
-		for filename in sorted(glob.glob(input_dir + 'reddit.*.500K')):
-			outfile = filename + '.nometa'
+	def open_text(filename):
+		'''
+		open a utf-8 text file for reading, decompressing .gz, .bz2 and .xz files on the fly
+		'''
+		if filename.endswith('.gz'): return gzip.open(filename, 'rt', encoding='utf-8')
+		if filename.endswith('.bz2'): return bz2.open(filename, 'rt', encoding='utf-8')
+		if filename.endswith('.xz') or filename.endswith('.lzma'): return lzma.open(filename, 'rt', encoding='utf-8')
+		return codecs.open(filename, 'r', 'utf-8')
+	# end def
 
-			with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
-				print('processing', filename)
-				for line in fin:
-					# raw text without metadata
-					index = Parsing.find_2nd_occurrence(line.strip(), ']')
+	@staticmethod
+	def partition_part(outfile, shard):
+		return outfile + '.' + str(shard) + '.part'
+	# end def
 
-					text = line.strip()[index + 2:]
-					metadata = line.strip()[:index + 1]
-					metadata = metadata.replace('[ ', '[').replace(' ]', ']')  # remove metadata spaces
-					# two metadata attributes and single non-alphabetical word
-					if len(text.split()) == 1 and not (text.isalpha()): continue
-					if not (Parsing.is_english_sentence(text)): continue
-					# fout.write(metadata + ' ' + text + '\n')
-					fout.write(text + '\n')
+	@staticmethod
+	def partition_shard(filename, countries, out_dir, shard):
+		'''
+		route the lines of a single raw dump to per-country part files
+		:param filename: raw '[author] [subreddit] text' dump, possibly compressed
+		:param countries: dict of subreddit to country
+		:param out_dir: output files dir
+		:param shard: index of the dump, names its part files
+		:return: dict of country to number of lines
+		'''
+		outfiles = {country: out_dir + PARTITION_FILENAME.format(country) for country in set(countries.values())}
+		routes = {subreddit: Utils.partition_part(outfiles[country], shard) for subreddit, country in countries.items()}
 
-				# end for
+		with Utils.open_text(filename) as fin, SubredditRouter(routes, keep_metadata=True) as router:
+			print('processing', filename)
+			router.route(fin)
+		# end with
+		return {country: router.counts[Utils.partition_part(outfile, shard)] for country, outfile in outfiles.items()}
+	# end def
+
+	@staticmethod
+	def partition_dumps(input_pattern, mapping_filename, out_dir, processes=None):
+		'''
+		split raw reddit dumps into per-country corpora (reddit.<country>.txt.tok) in a single pass over the dumps;
+		the dumps are processed concurrently and their parts are merged in the order of the dumps
+		:param input_pattern: glob pattern of the raw dumps, e.g., 'dir/*.tok' or 'dir/*.tok.gz'
+		:param mapping_filename: subreddit to country mapping, see Parsing.load_subreddit_countries
+		:param out_dir: output files dir
+		:param processes: number of processes, all cpus by default
+		:return: dict of country to number of lines, also saved to LINE_COUNTS_FILENAME in out_dir
+		'''
+		countries = Parsing.load_subreddit_countries(mapping_filename)
+		filenames = sorted(glob.glob(input_pattern))
+		tasks = [(filename, countries, out_dir, shard) for shard, filename in enumerate(filenames)]
+		with Stage('partition_dumps') as stage:
+			with mp.Pool(processes) as pool:
+				shard_counts = pool.starmap(Utils.partition_shard, tasks, chunksize=1)
 			# end with
+			for filename in filenames: stage.add_files(filename)
+
+			counts = collections.OrderedDict()
+			for country in sorted(set(countries.values())):
+				outfile = out_dir + PARTITION_FILENAME.format(country)
+				with open(outfile, 'wb') as fout:
+					for shard in range(len(filenames)):
+						part = Utils.partition_part(outfile, shard)
+						with open(part, 'rb') as fin: shutil.copyfileobj(fin, fout)
+						os.remove(part)
+					# end for
+				# end with
+				counts[country] = sum(shard_count[country] for shard_count in shard_counts)
+				stage.add(counts[country])
+				stage.add_files(outfile=outfile)
+			# end for
+		# end with
+
+		Utils.save_line_counts(counts, out_dir + LINE_COUNTS_FILENAME)
+		return counts
+	# end def
+
+	@staticmethod
+	def save_line_counts(counts, filename):
+		with codecs.open(filename, 'w', 'utf-8') as fout:
+			for country, count in counts.items(): fout.write(country + ' ' + str(count) + '\n')
+		# end with
+	# end def
+
+	@staticmethod
+	def load_line_counts(filename):
+		with codecs.open(filename, 'r', 'utf-8') as fin:
+			return collections.OrderedDict((line.split()[0], int(line.split()[1])) for line in fin if line.strip())
+		# end with
+	# end def
+
+	@staticmethod
+	def reservoir_sample(items, size, rng):
+		'''
+		uniform random sample of a stream in a single pass, keeping at most size items in memory
+		(reservoir sampling with geometric skips, Li 1994)
+		:param items: iterable of items
+		:param size: sample size, all items are kept (shuffled) if the stream is shorter
+		:param rng: random.Random instance
+		:return: list of the sampled items, in random order
+		'''
+		items = iter(items)
+		reservoir = list(itertools.islice(items, size))
+		if len(reservoir) == size and size > 0:
+			weight = math.exp(math.log(1.0 - rng.random()) / size)
+			while True:
+				skip = int(math.log(1.0 - rng.random()) / math.log(1.0 - weight))
+				item = next(itertools.islice(items, skip, None), None)
+				if item is None: break
+				reservoir[rng.randrange(size)] = item
+				weight *= math.exp(math.log(1.0 - rng.random()) / size)
+			# end while
+		# end if
+		rng.shuffle(reservoir)
+		return reservoir
+	# end def
+
+	@staticmethod
+	def line_offsets(fin):
+		offset = 0
+		for line in fin:
+			yield offset
+			offset += len(line)
 		# end for
 	# end def
+
+	@staticmethod
+	def sample_file(filename, size=SAMPLE_SIZE, seed=SAMPLE_SEED, offsets=False, suffix=SAMPLE_SUFFIX):
+		'''
+		write a shuffled uniform sample of the lines of a file to <filename><suffix>
+		:param filename: input file
+		:param size: number of lines to sample
+		:param seed: random seed, combined with the file name so that every file gets its own stream
+		:param offsets: keep byte offsets rather than lines in memory and read the sampled lines back,
+		for samples too large to hold in memory
+		:param suffix: output file suffix
+		:return: number of sampled lines
+		'''
+		rng = random.Random(str(seed) + ':' + os.path.basename(filename))
+		with open(filename, 'rb') as fin, open(filename + suffix, 'wb') as fout:
+			print('processing', filename)
+			if offsets:
+				sample = Utils.reservoir_sample(Utils.line_offsets(fin), size, rng)
+				for offset in sample:
+					fin.seek(offset)
+					line = fin.readline()
+					fout.write(line if line.endswith(b'\n') else line + b'\n')
+				# end for
+			else:
+				sample = Utils.reservoir_sample(fin, size, rng)
+				for line in sample: fout.write(line if line.endswith(b'\n') else line + b'\n')
+			# end if
+		# end with
+		return len(sample)
+	# end def
+
+	@staticmethod
+	def sample_corpora(input_pattern, size=SAMPLE_SIZE, seed=SAMPLE_SEED, offsets=False, processes=None):
+		'''
+		sample all (e.g., per-country) corpora concurrently, see sample_file
+		:return: dict of file name to number of sampled lines
+		'''
+		filenames = sorted(glob.glob(input_pattern))
+		tasks = [(filename, size, seed, offsets) for filename in filenames]
+		with Stage('sample_corpora') as stage, mp.Pool(processes) as pool:
+			sizes = pool.starmap(Utils.sample_file, tasks, chunksize=1)
+			stage.add(sum(sizes))
+			for filename in filenames: stage.add_files(filename, filename + SAMPLE_SUFFIX)
+		# end with
+		return collections.OrderedDict(zip(filenames, sizes))
+	# end def
+
+	@staticmethod
+	def strip_metadata(line):
+		'''
+		:param line: '[author] [subreddit] text' line
+		:return: raw text without metadata
+		'''
+		parsed = Parsing.parse_metadata(line)
+		return line.strip() if parsed is None else parsed[2]
+	# end def
+
+	@staticmethod
+	def is_short_non_alphabetical(text):
+		# two metadata attributes and single non-alphabetical word
+		return len(text.split()) == 1 and not (text.isalpha())
+	# end def
+
+	@staticmethod
+	def cleanup_line(line):
+		'''
+		strip the metadata of a line and filter out single non-alphabetical words and non-English text
+		:param line: '[author] [subreddit] text' line
+		:return: raw text without metadata, None if the line is filtered out
+		'''
+		text = Utils.strip_metadata(line)
+		if Utils.is_short_non_alphabetical(text): return None
+		if not (Parsing.is_english_sentence(text)): return None
+		return text
+	# end def
+
+	@staticmethod
+	def cleanup_lines(lines, language_filter):
+		'''
+		cleanup_line over a stream of lines, with batched language detection
+		:param lines: '[author] [subreddit] text' lines
+		:param language_filter: LanguageFilter
+		:return: generator of the raw English texts, in the order of the input lines
+		'''
+		texts = (Utils.strip_metadata(line) for line in lines)
+		texts = (text for text in texts if not Utils.is_short_non_alphabetical(text))
+		return language_filter.filter(texts)
+	# end def
+
+	@staticmethod
+	def perform_cleanup(input_dir, processes=1, english_words=None):
+		'''
+		strip the metadata and filter out non-English lines of the input files
+		:param input_dir: input files dir
+		:param processes: number of language detection processes
+		:param english_words: optional set of English words, see LanguageFilter
+		:return:
+		'''
+		with LanguageFilter(processes, english_words) as language_filter, Stage('perform_cleanup') as stage:
+			for filename in sorted(glob.glob(input_dir + 'reddit.*.500K')):
+				outfile = filename + '.nometa'
+
+				with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
+					print('processing', filename)
+					# raw text without metadata
+					for text in Utils.cleanup_lines(fin, language_filter):
+						fout.write(text + '\n')
+						stage.add(1)
+					# end for
+				# end with
+				stage.add_files(filename, outfile)
+			# end for
+		# end with
+	# end def
+# end class
+
+
+class LanguageFilter:
+	'''
+	batched English detection that keeps the order of the lines: lines without any letter are rejected and
+	lines made (almost) entirely of known English words are accepted without running the detector,
+	decisions of exact duplicate lines are cached, and the remaining lines are detected on a process pool
+	'''
+	def __init__(self, processes=1, english_words=None, cache_size=LANGUAGE_CACHE_SIZE):
+		self.pool = mp.Pool(processes) if processes != 1 else None
+		self.english_words = english_words
+		self.cache = collections.OrderedDict()
+		self.cache_size = cache_size
+	# end def
+
+	@staticmethod
+	def load_english_words(filename):
+		'''
+		load a set of English words from a '<count> <word>' vocabulary file, e.g., vocabulary.100.dat
+		'''
+		with codecs.open(filename, 'r', 'utf-8') as fin:
+			return set(line.split()[1].lower() for line in fin if len(line.split()) > 1)
+		# end with
+	# end def
+
+	def quick_decision(self, text):
+		'''
+		:return: True or False for trivially (non-)English text, None if the detector has to decide
+		'''
+		if not any(c.isalpha() for c in text): return False
+		if self.english_words is None or not text.isascii(): return None
+
+		words = [token.lower() for token in text.split() if token.isalpha()]
+		if len(words) < ENGLISH_MIN_WORDS: return None
+		known = sum(1 for word in words if word in self.english_words)
+		return True if known >= ENGLISH_WORDS_RATE * len(words) else None
+	# end def
+
+	def is_english(self, texts):
+		'''
+		:param texts: batch of texts
+		:return: list of booleans, in the order of the texts
+		'''
+		decisions = [None] * len(texts)
+		pending = collections.OrderedDict()
+		for i, text in enumerate(texts):
+			if text in self.cache:
+				decisions[i] = self.cache[text]
+				self.cache.move_to_end(text)
+				continue
+			# end if
+			decisions[i] = self.quick_decision(text)
+			if decisions[i] is None: pending.setdefault(text, []).append(i)
+		# end for
+
+		unique = list(pending.keys())
+		if self.pool is None: detected = map(Parsing.is_english_sentence, unique)
+		else: detected = self.pool.map(Parsing.is_english_sentence, unique, chunksize=LANGUAGE_CHUNK_SIZE)
+
+		for text, english in zip(unique, detected):
+			for i in pending[text]: decisions[i] = english
+			self.cache[text] = english
+			if len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+		# end for
+		return decisions
+	# end def
+
+	def filter(self, texts, batch_size=LANGUAGE_BATCH_SIZE):
+		'''
+		:return: generator of the English texts, in the order of the input texts
+		'''
+		texts = iter(texts)
+		while True:
+			batch = list(itertools.islice(texts, batch_size))
+			if not batch: break
+			for text, english in zip(batch, self.is_english(batch)):
+				if english: yield text
+			# end for
+		# end while
+	# end def
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+		# end if
+	# end def
+
+	def __enter__(self):
+		return self
+	# end def
+
+	def __exit__(self, *args):
+		self.close()
+	# end def
 # end class
 
 
 class AbstactRepresentation:
 	@staticmethod
-	def remove_short_sentences_and_named_entities(nlp, input_dir):
+	def mask_named_entities(nlp, sentence):
+		'''
+		substitute named entities with their labels, words out of the English vocabulary with 'FW'
+		and web links with 'URL' in a line processed by the spacy pipeline
+		:param nlp: the spacy nlp pipeline object
+		:param sentence: spacy doc of the (stripped) line
+		:return: masked line
+		'''
+		entity2label = {}
+		line_with_entities = []
+
+		line = sentence.text
+		for ent in sentence.ents: entity2label[ent.text] = ent.label_
+
+		prev_end = 0
+		for ent in sentence.ents:
+			line_with_entities.append(line[prev_end:ent.start_char])
+			line_with_entities.append(ent.label_)
+			prev_end = ent.end_char
+		# end for
+
+		line_with_entities.append(line[prev_end:])
+		line_with_entities = (' '.join(line_with_entities)).strip()
+
+		outline = []
+		for token in line_with_entities.split():
+			if token in entity2label.values(): # named entity
+				outline.append(token)
+			elif token.isalpha() and token not in nlp.vocab: # not in English vocabulary
+				outline.append('FW')
+			elif Parsing.is_web_link(token): # web link, r/<subreddit> or u/<username>
+				outline.append('URL')
+			else: # English word, not named entity
+				outline.append(token.lower())
+			# end if
+		# end for
+
+		return ' '.join(outline)
+	# end def
+
+	@staticmethod
+	def mask_named_entities_fast(nlp, sentence, vocabulary):
+		'''
+		mask_named_entities working on the entity spans of the doc rather than on the rebuilt line,
+		with set-based label and vocabulary checks and a single prefix check for web links;
+		the output is identical to that of mask_named_entities
+		:param nlp: the spacy nlp pipeline object
+		:param sentence: spacy doc of the (stripped) line
+		:param vocabulary: set of words already found in nlp.vocab, updated in place (the vocab only grows)
+		:return: masked line
+		'''
+		line = sentence.text
+		ents = sentence.ents
+		# labels of the last entity of every distinct text, as the entity2label values above
+		labels = set({ent.text: ent.label_ for ent in ents}.values())
+
+		tokens = []
+		prev_end = 0
+		for ent in ents:
+			tokens.extend(line[prev_end:ent.start_char].split())
+			tokens.append(ent.label_)
+			prev_end = ent.end_char
+		# end for
+		tokens.extend(line[prev_end:].split())
+
+		outline = []
+		for token in tokens:
+			if token in labels: # named entity
+				outline.append(token)
+			elif token.isalpha():
+				if token not in vocabulary:
+					if token not in nlp.vocab: # not in English vocabulary
+						outline.append('FW')
+						continue
+					# end if
+					vocabulary.add(token)
+				# end if
+				outline.append(token.lower())
+			elif token.startswith(WEB_LINK_PREFIXES): # web link, r/<subreddit> or u/<username>
+				outline.append('URL')
+			else: # English word, not named entity
+				outline.append(token.lower())
+			# end if
+		# end for
+
+		return ' '.join(outline)
+	# end def
+
+	@staticmethod
+	def mask_lines(nlp, lines, batch_size=1000, n_process=1, fast=False):
+		'''
+		mask named entities in a stream of lines, see mask_named_entities
+		:param fast: use mask_named_entities_fast
+		:return: generator of masked lines, in the order of the input lines
+		'''
+		vocabulary = set()
+		lines = (line.strip() for line in lines)
+		# spacy pipeline invocation, docs are yielded in the order of the input lines
+		for sentence in nlp.pipe(lines, batch_size=batch_size, n_process=n_process):
+			if fast: yield AbstactRepresentation.mask_named_entities_fast(nlp, sentence, vocabulary)
+			else: yield AbstactRepresentation.mask_named_entities(nlp, sentence)
+		# end for
+	# end def
+
+	@staticmethod
+	def remove_short_sentences_and_named_entities(nlp, input_dir, batch_size=1000, n_process=1, fast=False):
 		'''
 
 		:param nlp: the spacy nlp pipeline object
 		:param input_dir: input files dir to traverse
+		:param batch_size: number of lines the spacy pipeline processes at once
+		:param n_process: number of spacy worker processes
+		:param fast: use the fast masking path, see mask_named_entities_fast
 		:return:
 		'''
-		for filename in sorted(glob.glob(input_dir + 'reddit.*.tc')):
-			outfile = filename + '.masked.entities'
+		with Stage('mask_named_entities', progress=10000) as stage:
+			for filename in sorted(glob.glob(input_dir + 'reddit.*.tc')):
+				outfile = filename + '.masked.entities'
 
-			count = 0
-			with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
-				print('processing', filename)
-				for line in fin:
-					entity2label = {}
-					line_with_entities = []
-
-					line = line.strip()
-					sentence = nlp(line) # spacy pipeline invocation
-					for ent in sentence.ents: entity2label[ent.text] = ent.label_
-
-					prev_end = 0
-					for ent in sentence.ents:
-						line_with_entities.append(line[prev_end:ent.start_char])
-						line_with_entities.append(ent.label_)
-						prev_end = ent.end_char
+				with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
+					print('processing', filename)
+					for line in AbstactRepresentation.mask_lines(nlp, fin, batch_size, n_process, fast):
+						fout.write(line + '\n')
+						stage.add(1)
 					# end for
+				# end with
+				stage.add_files(filename, outfile)
+			# end for
+		# end with
+	# end def
 
-					line_with_entities.append(line[prev_end:])
-					line_with_entities = (' '.join(line_with_entities)).strip()
-
-					outline = []
-					for token in line_with_entities.split():
-						if token in entity2label.values(): # named entity
-							outline.append(token)
-						elif token.isalpha() and token not in nlp.vocab: # not in English vocabulary
-							outline.append('FW')
-						elif Parsing.is_web_link(token): # web link, r/<subreddit> or u/<username>
-							outline.append('URL')
-						else: # English word, not named entity
-							outline.append(token.lower())
+	@staticmethod
+	def pos_tag(nlp, input_dir, batch_size=1000, n_process=1, binary=False):
+		'''
+		annotate text for part-of-speech
+		:param nlp: the spacy nlp pipeline object
+		:param input_dir: input files dir to traverse
+		:param batch_size: number of lines the spacy pipeline processes at once
+		:param n_process: number of spacy worker processes
+		:param binary: also write token and tag ids with per-line offsets to <file>.pos.npz
+		:return:
+		'''
+		with Stage('pos_tag', progress=10000) as stage:
+			for filename in sorted(glob.glob(input_dir + '*')):
+				if filename.endswith(('.pos', '.pos.npz')): continue  # outputs of a previous run
+				outfile = filename + '.pos'
+
+				token_ids, tag_ids = {}, {}
+				tokens, tags, offsets = array.array('i'), array.array('i'), array.array('q', [0])
+
+				with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
+					print('processing', filename)
+					lines = (line.strip() for line in fin)
+					for sentence in nlp.pipe(lines, batch_size=batch_size, n_process=n_process):  # spacy pipeline
+						outline = []
+						for token in sentence: outline.append(token.text + '_' + token.tag_)
+						fout.write(' '.join(outline) + '\n')
+
+						if binary:
+							for token in sentence:
+								tokens.append(token_ids.setdefault(token.text, len(token_ids)))
+								tags.append(tag_ids.setdefault(token.tag_, len(tag_ids)))
+							# end for
+							offsets.append(len(tokens))
 						# end if
+						stage.add(1)
 					# end for
+				# end with
+				stage.add_files(filename, outfile)
+
+				if binary:
+					np.savez(outfile + '.npz', tokens=np.frombuffer(tokens, dtype=np.int32),
+						tags=np.frombuffer(tags, dtype=np.int32), offsets=np.frombuffer(offsets, dtype=np.int64),
+						vocabulary=np.array(list(token_ids), dtype=str), tagset=np.array(list(tag_ids), dtype=str))
+				# end if
+			# end for
+		# end with
+	# end def
 
-					fout.write(' '.join(outline) + '\n')
+	@staticmethod
+	def count_pos_tags(filename):
+		'''
+		aggregate per-word part-of-speech counts from the binary output of pos_tag
+		line i of the tagged file spans tokens[offsets[i]:offsets[i + 1]]
+		:param filename: <file>.pos.npz written by pos_tag
+		:return: vocabulary, tagset and (vocabulary x tagset) array of counts
+		'''
+		with np.load(filename) as data:
+			vocabulary, tagset = data['vocabulary'].tolist(), data['tagset'].tolist()
+			pairs = data['tokens'].astype(np.int64) * len(tagset) + data['tags']
+		# end with
+		counts = np.bincount(pairs, minlength=len(vocabulary) * len(tagset))
+		return vocabulary, tagset, counts.reshape(len(vocabulary), len(tagset))
+	# end def
 
-					if count % 10000 == 0: print(count)
-					count += 1
-				# end for
-			# end with
+	@staticmethod
+	def coarse_pos_counts(vocabulary, tagset, counts):
+		'''
+		collapse per-word tag counts into adjective, noun and verb counts, as in vocab.pos.pkl
+		:return: {'A': {word: count}, 'N': {word: count}, 'V': {word: count}}
+		'''
+		vocab_pos = {}
+		for label, prefix in (('A', 'JJ'), ('N', 'NN'), ('V', 'VB')):
+			columns = [j for j, tag in enumerate(tagset) if tag.startswith(prefix)]
+			totals = counts[:, columns].sum(axis=1)
+			vocab_pos[label] = {vocabulary[i]: int(totals[i]) for i in np.flatnonzero(totals)}
 		# end for
+		return vocab_pos
 	# end def
+# end class
+
 
+class Pipeline:
 	@staticmethod
-	def pos_tag(nlp, input_dir):
+	def write_through(lines, filename):
 		'''
-		annotate text for part-of-speech
+		write the lines passing between two stages to an intermediate file, for debugging
+		:return: generator of the same lines
+		'''
+		with codecs.open(filename, 'w', 'utf-8') as fout:
+			for line in lines:
+				fout.write(line + '\n')
+				yield line
+			# end for
+		# end with
+	# end def
+
+	@staticmethod
+	def run(nlp, input_dir, intermediate=False, batch_size=1000, n_process=1):
+		'''
+		chain cleanup, url cleanup, true casing and named entities masking over a single read of every input file
+		the output of the last stage is written to <file>.nometa.out.tc.masked.entities, the name the
+		separate stages produce; the outputs of the other stages are written only if intermediate is set
 		:param nlp: the spacy nlp pipeline object
 		:param input_dir: input files dir to traverse
+		:param intermediate: write the .nometa, .nometa.out and .nometa.out.tc files as well
+		:param batch_size: number of lines the spacy pipeline processes at once
+		:param n_process: number of spacy worker processes
 		:return:
 		'''
-		for filename in sorted(glob.glob(input_dir + '*')):
-			outfile = filename + '.pos'
+		casing = CachedCasing(Frequency.load())
+		language_filter = LanguageFilter()
+		with Stage('pipeline') as stage:
+			for filename in sorted(glob.glob(input_dir + 'reddit.*.500K')):
+				outfile = filename + '.nometa.out.tc.masked.entities'
 
-			count = 0
-			with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
-				print('processing', filename)
-				for line in fin:
-					outline = []
-					sentence = nlp(line.strip())  # spacy pipeline
-					for token in sentence: outline.append(token.text + '_' + token.tag_)
-					fout.write(' '.join(outline) + '\n')
-
-					if count % 10000 == 0: print(count)
-					count += 1
-				# end for
-			# end with
-		# end for
+				with codecs.open(filename, 'r', 'utf-8') as fin, codecs.open(outfile, 'w', 'utf-8') as fout:
+					print('processing', filename)
+					lines = Utils.cleanup_lines(fin, language_filter)
+					if intermediate: lines = Pipeline.write_through(lines, filename + '.nometa')
+
+					lines = (Parsing.url_cleanup_line(line) for line in lines)
+					if intermediate: lines = Pipeline.write_through(lines, filename + '.nometa.out')
+
+					lines = (SimpleTrueCasing.true_case_line(line, casing) for line in lines)
+					if intermediate: lines = Pipeline.write_through(lines, filename + '.nometa.out.tc')
+
+					for line in AbstactRepresentation.mask_lines(nlp, lines, batch_size, n_process):
+						fout.write(line + '\n')
+						stage.add(1)
+					# end for
+				# end with
+				stage.add_files(filename, outfile)
+				casing.report(filename)
+			# end for
+		# end with
 	# end def
 # end class
 
@@ -311,7 +1224,13 @@ if __name__ == '__main__':
 
 	# https://www.ngrams.info/download_coca.asp
 	NGRAMS_DIR = 'directory with n-gram frequencies, e.g., downloaded from COCA'
-	EUROPEAN_SUBREDDITS = ['europe', 'AskEurope', 'EuropeanCulture', 'EuropeanFederalists', 'Eurosceptics']
+	NGRAMS_INDEX_DIR = NGRAMS_DIR + 'index/'  # built once with Frequency.build_index(NGRAMS_DIR, NGRAMS_INDEX_DIR)
+	EUROPEAN_SUBREDDITS = Parsing.load_subreddits('european.subreddits.dat')
+
+	# raw dumps are split into per-country corpora once, given a '<subreddit> <country>' mapping file
+	#Utils.partition_dumps('directory with raw dumps/*.tok.gz', 'subreddit.countries.dat', 'output directory/')
+	# shuffled 1M-line samples of the (cleaned) per-country corpora
+	#Utils.sample_corpora('output directory/reddit.*.txt.tok.nometa.clean.lc')
 
 	processor = AbstactRepresentation()
 
@@ -320,14 +1239,19 @@ if __name__ == '__main__':
 	input_dir = 'directory with input files, the data is available at http://cl.haifa.ac.il/projects/l2'
 
 	SimpleTrueCasing.true_case(input_dir)
+	# or concurrently, skipping files completed by previous runs
+	#SimpleTrueCasing.true_case_parallel(input_dir)
 
 	nlp = spacy.load('en_core_web_lg', disable=['parser', 'tagger'])
 	processor.remove_short_sentences_and_named_entities(nlp, input_dir)
 
+	# alternatively, run all stages over a single read of the raw files
+	#Pipeline.run(nlp, input_dir, intermediate=False)
+
 	# refer to https://spacy.io/usage/models for models
 	#nlp = spacy.load('en_core_web_sm', disable=['parser', 'entity'])
 	#input_dir = 'directory with input files, the data is available at http://cl.haifa.ac.il/projects/l2'
-	#pos_tag(nlp, input_dir)
+	#processor.pos_tag(nlp, input_dir, binary=True)
 
 	print('finished')
 